@@ -0,0 +1,107 @@
+#!/usr/local/bin/python
+"""
+Benchmark BOOKOCR assembly on a synthetic OCR zip.
+
+    python benchmarks/bench_bookocr.py [--pages 5000] [--page-kb 4]
+
+Times the streaming assembly (utils.ocr.OcrZip) against the old one, which looked every page up
+in namelist() and joined all pages into one string, and reports the peak memory of each.  Every
+run happens in a child process of its own, so the peaks don't mask each other.
+"""
+
+import os
+import sys
+import time
+import random
+import resource
+import zipfile
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.ocr import OcrZip
+
+WORDS = ['the', 'of', 'and', 'pittsburgh', 'county', 'allegheny', 'river', 'street', 'company',
+         'history', 'council', 'page', 'bridge', 'iron', 'steel', 'works', 'railroad', 'ward']
+
+def write_synthetic_zip(path, pages, page_kb):
+    """
+    Write an OCR zip with one <page>.txt member of about @page_kb KB of words per page.
+    """
+    rand = random.Random(pages)
+    ocr_zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    for n in range(1, pages + 1):
+        words = []
+        size = 0
+        while size < page_kb * 1024:
+            word = rand.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        ocr_zip.writestr('%08d.txt' % (n,), ' '.join(words))
+    ocr_zip.close()
+    return ['%08d.tif' % (n,) for n in range(1, pages + 1)]
+
+def legacy_book_ocr(zip_path, page_names, out):
+    # what handle_text_object did before: a namelist() scan per page and the whole book in memory
+    ocr_zip = zipfile.ZipFile(zip_path, 'r')
+    ocr_page_list = []
+    for page_name in page_names:
+        ocr_filename = '%s.txt' % (os.path.splitext(page_name)[0],)
+        if ocr_filename in ocr_zip.namelist():
+            ocr_page_list.append(ocr_zip.read(ocr_filename))
+    ocr_book_data = ''.join(ocr_page_list)
+    out.write(ocr_book_data)
+    ocr_zip.close()
+    return len(ocr_book_data)
+
+def streaming_book_ocr(zip_path, page_names, out):
+    ocr_zip = OcrZip(zip_path)
+    infos = [info for info in (ocr_zip.pageInfo(name) for name in page_names) if info]
+    sent = 0
+    for block in ocr_zip.iterText(infos):
+        out.write(block)
+        sent += len(block)
+    ocr_zip.close()
+    return sent
+
+def run(func, zip_path, page_names, results):
+    # child process: the peak RSS is this run's alone
+    out = open(os.devnull, 'wb')
+    start = time.time()
+    sent = func(zip_path, page_names, out)
+    elapsed = time.time() - start
+    out.close()
+    results.put((sent, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+def measure(func, zip_path, page_names):
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run, args=(func, zip_path, page_names, results))
+    p.start()
+    result = results.get()
+    p.join()
+    return result
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--pages', type='int', default=5000, help="pages in the synthetic book")
+    parser.add_option('--page-kb', type='int', default=4, help="KB of text per page")
+    options, args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench-bookocr-')
+    zip_path = os.path.join(work_dir, 'ocr.zip')
+    try:
+        page_names = write_synthetic_zip(zip_path, options.pages, options.page_kb)
+        print("%d pages, %.1f MB of text, zip %.1f MB" % (options.pages, options.pages * options.page_kb / 1024.0, os.path.getsize(zip_path) / 1024.0 / 1024))
+        print("%10s %12s %10s %12s" % ("method", "bytes", "time", "peak RSS MB"))
+        sizes = []
+        for name, func in (('streaming', streaming_book_ocr), ('legacy', legacy_book_ocr)):
+            sent, elapsed, peak = measure(func, zip_path, page_names)
+            sizes.append(sent)
+            print("%10s %12d %9.3fs %12.1f" % (name, sent, elapsed, peak))
+        assert sizes[0] == sizes[1]
+    finally:
+        os.remove(zip_path)
+        os.rmdir(work_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/local/bin/python
+"""
+Benchmark whole item ingest against a local Fedora stand-in (benchmarks/fedora_stub.py).
+
+    python benchmarks/bench_ingest.py [--scenarios image,map,book,manuscript] [--items 20] [--pages 50]
+        [--workers 1] [--latency 0.005] [--error-rate 0.0] [--page-mode datastreams]
+
+Each scenario writes synthetic items of one legacy type (see benchmarks/fixtures.py), starts a
+fresh stub and runs migrate_drl_to_fedora.ingest_collection over them in a child process of its
+own, then reports items and fedora objects per second, the requests the stub answered by kind,
+and the peak RSS of the ingest process.  JP2 encoding is a file copy (plus --encode-ms) and MIX
+extraction returns a fixed document, so the numbers show the cost of the migration code and the
+fedora round trips rather than of kakadu and jhove.  fcrepo, islandoraUtils and lxml must be
+installed; the workflow database and drl are replaced by the fixtures.
+"""
+
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fedora_stub import FedoraStub
+import fixtures
+
+COLLECTION = 'benchcoll'
+NAMESPACE = 'bench'
+# scenario name -> legacy item type
+SCENARIOS = {
+    'image': 'image',
+    'map': 'map',
+    'book': 'text - cataloged',
+    'manuscript': 'manuscript',
+}
+MIX = ('<?xml version="1.0" encoding="UTF-8"?>\n<mix:mix xmlns:mix="http://www.loc.gov/mix/v20">'
+       '<mix:BasicImageInformation><mix:BasicImageCharacteristics><mix:imageWidth>2000</mix:imageWidth>'
+       '<mix:imageHeight>3000</mix:imageHeight></mix:BasicImageCharacteristics></mix:BasicImageInformation></mix:mix>\n')
+
+def _importMigration():
+    fixtures.installModels()
+    import migrate_drl_to_fedora
+    return migrate_drl_to_fedora
+
+class _MixResult:
+    def get(self, timeout=None):
+        return MIX
+
+def _copyEncoder():
+    from utils.derivatives import Jp2Encoder
+
+    class CopyJp2Encoder(Jp2Encoder):
+        """
+        Stands in for kakadu: copies the master and sleeps @delay seconds.
+        """
+        delay = 0.0
+
+        def encode(self, tiffPath, workDir):
+            jp2Path = os.path.join(workDir, '%s.jp2' % os.path.splitext(os.path.basename(tiffPath))[0])
+            shutil.copyfile(tiffPath, jp2Path)
+            if self.delay:
+                time.sleep(self.delay)
+            return jp2Path
+    return CopyJp2Encoder
+
+def run_scenario(options, typeName, url, workDir, results):
+    # child process: the peak RSS is this scenario's alone
+    if not options.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    migrate = _importMigration()
+    from utils.derivatives import MixExtractor, registerEncoder
+    encoder = _copyEncoder()
+    encoder.delay = options.encode_ms / 1000.0
+    # registered before the encoder pool is forked, so its workers know it too
+    registerEncoder('bench', encoder)
+
+    class FixedMixExtractor(MixExtractor):
+        def submit(self, tiffPath):
+            return _MixResult()
+
+    migrate.FEDORA_URL = url
+    migrate.COLL_NS_MAP[COLLECTION] = NAMESPACE
+    migrate.JOURNAL_PATH = os.path.join(workDir, 'journal.db')
+    migrate.METRICS_PATH = options.metrics and os.path.join(options.metrics, '%s.jsonl' % typeName.split()[0]) or None
+    migrate.METRICS_SUMMARY_INTERVAL = None
+    migrate.DERIVATIVE_CACHE_DIR = None
+    migrate.JP2_ENCODER = 'bench'
+    migrate.PAGE_INGEST_MODE = options.page_mode
+    migrate._mix_extractor = FixedMixExtractor()
+    for n in range(options.items):
+        fixtures.makeItem(workDir, COLLECTION, n, typeName, options.pages, options.tiff_kb, options.page_kb)
+
+    start = time.time()
+    try:
+        outcome = migrate.ingest_collection(COLLECTION, options.workers, use_threads=True)
+    except:
+        results.put(None)
+        raise
+    elapsed = time.time() - start
+    failed = len([ok for do_id, ok, message in outcome if not ok])
+    results.put((len(outcome), failed, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+def measure(options, name):
+    stub = FedoraStub(latency=options.latency, latencyPerMb=options.latency_per_mb, errorRate=options.error_rate).start()
+    workDir = tempfile.mkdtemp(prefix='bench-ingest-')
+    try:
+        results = multiprocessing.Queue()
+        p = multiprocessing.Process(target=run_scenario, args=(options, SCENARIOS[name], stub.url, workDir, results))
+        p.start()
+        result = results.get()
+        p.join()
+        if result is None:
+            raise RuntimeError("scenario %s failed" % name)
+        items, failed, elapsed, peak = result
+    finally:
+        stub.stop()
+        shutil.rmtree(workDir)
+    return items, failed, elapsed, peak, stub
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--scenarios', default='image,map,book,manuscript', help="comma separated scenarios: %s" % ', '.join(sorted(SCENARIOS)))
+    parser.add_option('--items', type='int', default=20, help="items per scenario")
+    parser.add_option('--pages', type='int', default=50, help="pages per book or manuscript")
+    parser.add_option('--tiff-kb', type='int', default=1024, help="KB per master tiff")
+    parser.add_option('--page-kb', type='int', default=4, help="KB of OCR text per page")
+    parser.add_option('--workers', type='int', default=1, help="items ingested at once (threads)")
+    parser.add_option('--page-mode', default='datastreams', choices=['datastreams', 'foxml'], help="book page ingest mode, see PAGE_INGEST_MODE")
+    parser.add_option('--encode-ms', type='float', default=0.0, help="milliseconds added to every jp2 encode")
+    parser.add_option('--latency', type='float', default=0.005, help="seconds the stub adds to every request")
+    parser.add_option('--latency-per-mb', type='float', default=0.0, help="seconds the stub adds per MB received")
+    parser.add_option('--error-rate', type='float', default=0.0, help="share of writes the stub fails with an object lock error")
+    parser.add_option('--metrics', help="directory to keep each scenario's metrics file in")
+    parser.add_option('--verbose', action='store_true', default=False, help="show the migration's output")
+    options, args = parser.parse_args()
+    names = options.scenarios.split(',')
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario '%s'" % name)
+
+    print("%d items per scenario, %d pages per book, %d KB tiffs, %d workers, %.3fs latency, %.1f%% errors"
+          % (options.items, options.pages, options.tiff_kb, options.workers, options.latency, options.error_rate * 100))
+    print("%10s %6s %7s %8s %9s %10s %9s %8s %7s %9s %12s" % ("scenario", "items", "failed", "objects", "time", "items/s", "objects/s", "requests", "errors", "MB sent", "peak RSS MB"))
+    for name in names:
+        items, failed, elapsed, peak, stub = measure(options, name)
+        requests = stub.requests()
+        print("%10s %6d %7d %8d %8.2fs %10.2f %9.2f %8d %7d %9.1f %12.1f"
+              % (name, items, failed, len(stub.objects), elapsed, items / elapsed, len(stub.objects) / elapsed,
+                 requests, stub.counts.get('errors', 0), stub.bytesReceived / 1024.0 / 1024, peak))
+        print("%10s %s" % ('', ', '.join(['%s %d' % (kind, n) for kind, n in sorted(stub.counts.items()) if kind != 'errors'])))
+
+if __name__ == '__main__':
+    main()
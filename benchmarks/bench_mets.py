@@ -0,0 +1,83 @@
+#!/usr/local/bin/python
+"""
+Benchmark METS page label extraction (utils.mets.getPageLabels) on synthetic METS files.
+
+    python benchmarks/bench_mets.py [--pages 10,1000,20000] [--legacy-max 1000]
+
+For comparison the old per-file XPath lookup is timed as well, up to --legacy-max pages (it
+grows with the square of the page count).
+"""
+
+import os
+import sys
+import time
+import resource
+import tempfile
+from optparse import OptionParser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lxml import etree
+from utils.mets import getPageLabels
+
+def write_synthetic_mets(path, pages):
+    """
+    Write a METS file with @pages page images, a fileSec entry and a structMap page div each.
+    """
+    f = open(path, 'w')
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    f.write('<mets:mets xmlns:mets="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink">\n')
+    f.write('<mets:fileSec><mets:fileGrp USE="image">\n')
+    for n in range(1, pages + 1):
+        f.write('<mets:file ID="img%08d" MIMETYPE="image/tiff"><mets:FLocat LOCTYPE="URL" xlink:href="%08d.tif"/></mets:file>\n' % (n, n))
+    f.write('</mets:fileGrp></mets:fileSec>\n')
+    f.write('<mets:structMap><mets:div TYPE="book">\n')
+    for n in range(1, pages + 1):
+        label = n % 50 == 0 and 'unum' or str(n)
+        f.write('<mets:div TYPE="page" ORDER="%d" LABEL="%s"><mets:fptr FILEID="img%08d"/></mets:div>\n' % (n, label, n))
+    f.write('</mets:div></mets:structMap>\n</mets:mets>\n')
+    f.close()
+
+def legacy_page_labels(mets_path):
+    # the lookup get_page_label_dict_from_mets used before: one document-wide XPath per file
+    METS_NS_MAP = {'mets': 'http://www.loc.gov/METS/'}
+    mets = etree.parse(open(mets_path, 'r'))
+    labels = {}
+    for file in mets.iter('{http://www.loc.gov/METS/}file'):
+        file_id = file.get('ID')
+        file_name = file[0].get('{http://www.w3.org/1999/xlink}href')
+        xpath_string = '//mets:div[@TYPE="page"]/mets:fptr[@FILEID="%s"]' % (file_id,)
+        fptr = mets.xpath(xpath_string, namespaces=METS_NS_MAP)[0]
+        labels[file_name] = fptr.getparent().get('LABEL')
+    return labels
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--pages', default='10,1000,20000', help="comma separated page counts to test")
+    parser.add_option('--legacy-max', type='int', default=1000, help="largest page count to time the old XPath lookup on")
+    options, args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench-mets-')
+    try:
+        print("%8s %10s %12s %12s %12s" % ("pages", "mets KB", "single-pass", "legacy", "peak RSS MB"))
+        for pages in [int(p) for p in options.pages.split(',')]:
+            path = os.path.join(work_dir, 'mets-%d.xml' % pages)
+            write_synthetic_mets(path, pages)
+            labels, elapsed = timed(getPageLabels, path)
+            assert len(labels) == pages
+            legacy = '-'
+            if pages <= options.legacy_max:
+                legacy_labels, legacy_elapsed = timed(legacy_page_labels, path)
+                assert legacy_labels == labels
+                legacy = '%.3fs' % legacy_elapsed
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+            print("%8d %10d %11.3fs %12s %12.1f" % (pages, os.path.getsize(path) / 1024, elapsed, legacy, peak))
+            os.remove(path)
+    finally:
+        os.rmdir(work_dir)
+
+if __name__ == '__main__':
+    main()
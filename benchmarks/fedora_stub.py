@@ -0,0 +1,372 @@
+#!/usr/local/bin/python
+"""
+A local stand-in for the Fedora 3 REST API, for benchmarking the migration without the
+production repository.
+
+It answers the calls the migration makes through fcrepo's FedoraClient and utils.commonFedora:
+the WADL a FedoraClient reads when it is made, object profiles (getObject), object creation and
+FOXML ingest (createObject, ingestFoxml), datastream listing, datastream add/modify (RELS-EXT
+included) and datastream profiles and content.  Objects live in memory; only small datastreams keep their content, the others just
+their size and MD5.  Every request can be delayed (@latency seconds plus @latencyPerMb per MB
+received) and a share of the write requests (@errorRate) fails with the 500 fedora gives when an
+object is locked by another thread.  With @keepAliveTimeout, connections left unused for that
+long are closed, as the servlet container in front of fedora does.
+
+    python benchmarks/fedora_stub.py [--port 8080] [--latency 0.02] [--error-rate 0.01] [--keep-alive-timeout 20]
+
+runs it on its own; the benchmarks start it in-process with FedoraStub(...).start().
+"""
+
+import re
+import sys
+import time
+import socket
+import random
+import urllib
+import hashlib
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from xml.sax.saxutils import escape, quoteattr
+from optparse import OptionParser
+
+ACCESS_NS = 'http://www.fedora.info/definitions/1/0/access/'
+MANAGEMENT_NS = 'http://www.fedora.info/definitions/1/0/management/'
+# datastreams up to this size keep their content, so RELS-EXT and the like can be read back
+KEEP_CONTENT = 64 * 1024
+LOCKED_MESSAGE = 'org.fcrepo.server.errors.ObjectLockedException: The object "%s" is currently being modified by another thread'
+
+# the REST methods fcrepo may call, as (id, http method, resource path below /objects/{pid}, query
+# parameters); served as the WADL fcrepo builds its API from
+_DS_PARAMS = ('controlGroup', 'dsLocation', 'altIDs', 'dsLabel', 'versionable:boolean', 'dsState', 'formatURI',
+              'checksumType', 'checksum', 'mimeType', 'logMessage')
+_WADL_METHODS = (
+    ('getObjectProfile', 'GET', '', ('format', 'asOfDateTime')),
+    ('createObject', 'POST', '', ('label', 'format', 'encoding', 'namespace', 'ownerId', 'logMessage', 'state')),
+    ('ingest', 'POST', '', ('label', 'format', 'encoding', 'namespace', 'ownerId', 'logMessage', 'state')),
+    ('updateObject', 'PUT', '', ('label', 'ownerId', 'state', 'logMessage', 'lastModifiedDate')),
+    ('deleteObject', 'DELETE', '', ('logMessage',)),
+    ('listDatastreams', 'GET', 'datastreams', ('format', 'asOfDateTime')),
+    ('getDatastreamProfile', 'GET', 'datastreams/{dsID}', ('format', 'asOfDateTime', 'validateChecksum:boolean')),
+    ('addDatastream', 'POST', 'datastreams/{dsID}', _DS_PARAMS),
+    ('modifyDatastream', 'PUT', 'datastreams/{dsID}', _DS_PARAMS + ('ignoreContent:boolean', 'lastModifiedDate')),
+    ('deleteDatastream', 'DELETE', 'datastreams/{dsID}', ('startDT', 'endDT', 'logMessage')),
+    ('getDatastream', 'GET', 'datastreams/{dsID}/content', ('asOfDateTime', 'download:boolean')),
+)
+
+def _wadl(baseUrl):
+    # nested resources, as fedora's own WADL has them: fcrepo joins the paths of a method's
+    # ancestor resources into its url
+    def resource(path, depth):
+        methods = []
+        for id, name, methodPath, params in _WADL_METHODS:
+            if methodPath != path:
+                continue
+            params = [param.split(':') + ['string'] for param in params]
+            methods.append('<method id="%s" name="%s"><request>%s</request></method>'
+                           % (id, name, ''.join(['<param name="%s" style="query" type="xs:%s"/>' % (param[0], param[1]) for param in params])))
+        children = set([p.split('/')[depth] for id, name, p, params in _WADL_METHODS
+                        if p.startswith(path) and len(p.split('/')) > depth and p != path and (not path or p[len(path)] == '/')])
+        nested = ''.join([resource(path and '%s/%s' % (path, child) or child, depth + 1) for child in sorted(children)])
+        return '<resource path=%s>%s%s</resource>' % (quoteattr(path and path.split('/')[-1] or '{pid}'), ''.join(methods), nested)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<application xmlns="http://research.sun.com/wadl/2006/10" xmlns:xs="http://www.w3.org/2001/XMLSchema">'
+            '<resources base=%s><resource path="/">%s</resource></resources></application>'
+            % (quoteattr(baseUrl + '/objects'), resource('', 0)))
+
+_FOXML_DATASTREAM = re.compile(r'<(?:\w+:)?datastream\s([^>]*)>')
+_FOXML_ATTRIBUTE = re.compile(r'\b(ID|CONTROL_GROUP)="([^"]*)"')
+_FOXML_LABEL = re.compile(r'model#label"\s+VALUE="([^"]*)"')
+
+def _now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+
+class _Datastream:
+    def __init__(self, dsid, label, mimeType, controlGroup):
+        self.dsid = dsid
+        self.label = label
+        self.mimeType = mimeType
+        self.controlGroup = controlGroup
+        self.version = -1
+        self.set('')
+
+    def set(self, content, size=None, md5=None):
+        self.version += 1
+        self.size = size is None and len(content) or size
+        self.checksum = md5 or hashlib.md5(content).hexdigest()
+        self.content = self.size <= KEEP_CONTENT and content or None
+        self.modified = _now()
+
+class _Object:
+    def __init__(self, pid, label):
+        self.pid = pid
+        self.label = label
+        self.created = _now()
+        # fedora gives every new object a DC datastream
+        dc = _Datastream('DC', 'Dublin Core Record for this object', 'text/xml', 'X')
+        dc.set('<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:identifier>%s</dc:identifier></oai_dc:dc>' % escape(pid))
+        self.datastreams = {'DC': dc}
+
+class FedoraStub:
+    def __init__(self, port=0, latency=0.0, latencyPerMb=0.0, errorRate=0.0, seed=1, keepAliveTimeout=None):
+        """
+        @param port The port to listen on, 0 for any free one (see url)
+        @param latency Seconds every request is delayed by
+        @param latencyPerMb Further seconds per MB of request body
+        @param errorRate Share of write requests that fail with an object lock error
+        @param keepAliveTimeout Seconds an idle connection is kept open, None for as long as the
+               client keeps it
+        """
+        self.latency = latency
+        self.latencyPerMb = latencyPerMb
+        self.errorRate = errorRate
+        self.objects = {}
+        self.counts = {}
+        self.bytesReceived = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(_Handler):
+            pass
+        Handler.stub = stub
+        Handler.timeout = keepAliveTimeout
+        self.server = _ThreadingServer(('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:%d/fedora' % (self.server.server_address[1],)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fedora-stub')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name):
+        self._lock.acquire()
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self._lock.release()
+
+    def requests(self):
+        return sum([n for name, n in self.counts.iteritems() if name != 'errors'])
+
+    def shouldFail(self):
+        if not self.errorRate:
+            return False
+        self._lock.acquire()
+        try:
+            return self._random.random() < self.errorRate
+        finally:
+            self._lock.release()
+
+class _ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+
+    def handle_error(self, request, clientAddress):
+        # clients drop keep-alive connections at will; fcrepo does whenever it left a response
+        # unread and has to reconnect
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, clientAddress)
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stub = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _readBody(self):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return ''.join(chunks)
+        return self.rfile.read(int(self.headers.get('content-length') or 0))
+
+    def _reply(self, status, body='', contentType='text/xml', headers=()):
+        # the whole response in one write; header lines written one by one meet the client's
+        # delayed ACKs and cost tens of milliseconds a request
+        lines = ['%s %d %s' % (self.protocol_version, status, self.responses.get(status, ('',))[0]),
+                 'Server: fedora-stub', 'Date: %s' % self.date_time_string(),
+                 'Content-Type: %s' % contentType, 'Content-Length: %d' % len(body)]
+        lines.extend(['%s: %s' % header for header in headers])
+        self.wfile.write('\r\n'.join(lines) + '\r\n\r\n' + body)
+
+    def _handle(self, method):
+        stub = self.stub
+        body = self._readBody()
+        url = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        parts = [urllib.unquote(p) for p in url.path.split('/') if p]
+        if parts and parts[0] == 'fedora':
+            parts = parts[1:]
+        stub._lock.acquire()
+        stub.bytesReceived += len(body)
+        stub._lock.release()
+        delay = stub.latency + stub.latencyPerMb * len(body) / (1024.0 * 1024)
+        if delay:
+            time.sleep(delay)
+        if parts == ['objects', 'application.wadl']:
+            # read by every FedoraClient as it is made
+            stub.count('GET wadl')
+            return self._reply(200, _wadl(stub.url), 'application/vnd.sun.wadl+xml')
+        if len(parts) < 2 or parts[0] != 'objects':
+            stub.count('%s other' % method)
+            return self._reply(404, 'not found', 'text/plain')
+        pid = parts[1]
+        if method != 'GET' and stub.shouldFail():
+            stub.count('errors')
+            return self._reply(500, LOCKED_MESSAGE % pid, 'text/plain')
+        if len(parts) == 2:
+            return self._object(method, pid, params, body)
+        if len(parts) == 3 and parts[2] == 'datastreams':
+            stub.count('GET datastreams')
+            return self._listDatastreams(pid)
+        if len(parts) >= 4 and parts[2] == 'datastreams':
+            return self._datastream(method, pid, parts[3], len(parts) > 4 and parts[4] == 'content', params, body)
+        stub.count('%s other' % method)
+        self._reply(404, 'not found', 'text/plain')
+
+    def _object(self, method, pid, params, body):
+        stub = self.stub
+        obj = stub.objects.get(pid)
+        if method == 'GET':
+            stub.count('GET object')
+            if obj is None:
+                return self._reply(404, 'Object not found in low-level storage: %s' % pid, 'text/plain')
+            return self._reply(200, self._objectProfile(obj))
+        if method == 'POST':
+            # ingestFoxml names the FOXML format, fcrepo's createObject sends its own bare FOXML
+            stub.count(params.get('format') and 'POST ingest' or 'POST object')
+            foxml = body[:256].lstrip().startswith('<')
+            stub._lock.acquire()
+            try:
+                if pid in stub.objects:
+                    return self._reply(500, 'org.fcrepo.server.errors.ObjectExistsException: The PID \'%s\' already exists in the registry' % pid, 'text/plain')
+                label = params.get('label', '')
+                if foxml:
+                    found = _FOXML_LABEL.search(body[:4096])
+                    label = found and found.group(1) or label
+                obj = stub.objects[pid] = _Object(pid, label)
+            finally:
+                stub._lock.release()
+            if foxml:
+                for attributes in _FOXML_DATASTREAM.findall(body):
+                    attributes = dict(_FOXML_ATTRIBUTE.findall(attributes))
+                    dsid = attributes.get('ID')
+                    ds = obj.datastreams.get(dsid) or _Datastream(dsid, dsid, 'application/octet-stream', attributes.get('CONTROL_GROUP', 'M'))
+                    # the size of the encoded content is close enough for a benchmark
+                    ds.set('', size=0)
+                    obj.datastreams[dsid] = ds
+            return self._reply(201, pid, 'text/plain', [('Location', '%s/objects/%s' % (stub.url, pid))])
+        if method == 'DELETE':
+            stub.count('DELETE object')
+            stub.objects.pop(pid, None)
+            return self._reply(200, '', 'text/plain')
+        stub.count('%s other' % method)
+        self._reply(405, 'method not allowed', 'text/plain')
+
+    def _datastream(self, method, pid, dsid, content, params, body):
+        stub = self.stub
+        obj = stub.objects.get(pid)
+        stub.count('%s datastream%s' % (method, content and ' content' or ''))
+        if obj is None:
+            return self._reply(404, 'Object not found in low-level storage: %s' % pid, 'text/plain')
+        ds = obj.datastreams.get(dsid)
+        if method == 'GET':
+            if ds is None:
+                return self._reply(404, 'No datastream %s for %s' % (dsid, pid), 'text/plain')
+            if content:
+                return self._reply(200, ds.content or '', ds.mimeType)
+            return self._reply(200, self._datastreamProfile(obj, ds))
+        if method in ('POST', 'PUT'):
+            status = 200
+            if ds is None:
+                if method == 'PUT':
+                    return self._reply(404, 'No datastream %s for %s' % (dsid, pid), 'text/plain')
+                ds = obj.datastreams[dsid] = _Datastream(dsid, '', 'application/octet-stream', params.get('controlGroup', 'M'))
+                status = 201
+            ds.label = params.get('dsLabel', ds.label)
+            ds.mimeType = params.get('mimeType', ds.mimeType)
+            ds.set(body)
+            return self._reply(status, self._datastreamProfile(obj, ds))
+        if method == 'DELETE':
+            obj.datastreams.pop(dsid, None)
+            return self._reply(200, '', 'text/plain')
+        self._reply(405, 'method not allowed', 'text/plain')
+
+    def _objectProfile(self, obj):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<objectProfile xmlns="%s" pid=%s>'
+                '<objLabel>%s</objLabel><objOwnerId>fedoraAdmin</objOwnerId>'
+                '<objModels><model>info:fedora/fedora-system:FedoraObject-3.0</model></objModels>'
+                '<objCreateDate>%s</objCreateDate><objLastModDate>%s</objLastModDate>'
+                '<objDissIndexViewURL>%s/objects/%s/methods/fedora-system:3/viewMethodIndex</objDissIndexViewURL>'
+                '<objItemIndexViewURL>%s/objects/%s/methods/fedora-system:3/viewItemIndex</objItemIndexViewURL>'
+                '<objState>A</objState></objectProfile>'
+                % (ACCESS_NS, quoteattr(obj.pid), escape(obj.label), obj.created, obj.created,
+                   self.stub.url, obj.pid, self.stub.url, obj.pid))
+
+    def _listDatastreams(self, pid):
+        obj = self.stub.objects.get(pid)
+        if obj is None:
+            return self._reply(404, 'Object not found in low-level storage: %s' % pid, 'text/plain')
+        entries = ''.join(['<datastream dsid=%s label=%s mimeType=%s/>' % (quoteattr(ds.dsid), quoteattr(ds.label), quoteattr(ds.mimeType))
+                           for ds in obj.datastreams.values()])
+        self._reply(200, '<?xml version="1.0" encoding="UTF-8"?>\n<objectDatastreams xmlns="%s" pid=%s baseURL=%s>%s</objectDatastreams>'
+                    % (ACCESS_NS, quoteattr(pid), quoteattr(self.stub.url + '/'), entries))
+
+    def _datastreamProfile(self, obj, ds):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<datastreamProfile xmlns="%s" pid=%s dsID=%s>'
+                '<dsLabel>%s</dsLabel><dsVersionID>%s.%d</dsVersionID><dsCreateDate>%s</dsCreateDate>'
+                '<dsState>A</dsState><dsMIME>%s</dsMIME><dsFormatURI></dsFormatURI>'
+                '<dsControlGroup>%s</dsControlGroup><dsSize>%d</dsSize><dsVersionable>true</dsVersionable>'
+                '<dsInfoType></dsInfoType><dsLocation>%s+%s+%s.%d</dsLocation><dsLocationType>INTERNAL_ID</dsLocationType>'
+                '<dsChecksumType>MD5</dsChecksumType><dsChecksum>%s</dsChecksum></datastreamProfile>'
+                % (MANAGEMENT_NS, quoteattr(obj.pid), quoteattr(ds.dsid), escape(ds.label), ds.dsid, ds.version,
+                   ds.modified, escape(ds.mimeType), ds.controlGroup, ds.size, obj.pid, ds.dsid, ds.dsid,
+                   ds.version, ds.checksum))
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--latency', type='float', default=0.0, help="seconds added to every request")
+    parser.add_option('--latency-per-mb', type='float', default=0.0, help="seconds added per MB of request body")
+    parser.add_option('--error-rate', type='float', default=0.0, help="share of writes failing with an object lock error")
+    parser.add_option('--keep-alive-timeout', type='float', help="seconds before an idle connection is closed")
+    options, args = parser.parse_args()
+    stub = FedoraStub(options.port, options.latency, options.latency_per_mb, options.error_rate, keepAliveTimeout=options.keep_alive_timeout)
+    print("fedora stub at %s" % stub.url)
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(stub.counts)
+
+if __name__ == '__main__':
+    main()
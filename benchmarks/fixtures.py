@@ -0,0 +1,174 @@
+"""
+Synthetic fixtures for the ingest benchmarks.
+
+Items of each legacy type are written to a scratch directory with every file the migration
+reads (MODS, DC, thumbnail, master TIFFs and, for books, MARCXML, METS and the OCR zip), and
+installModels() puts stand-ins for the workflow models and drl.utils in sys.modules, serving
+those items, so migrate_drl_to_fedora can be imported and run without the DLXS workflow
+database.  Only the queries the migration makes are supported.
+"""
+
+import os
+import sys
+import imp
+import struct
+from bench_mets import write_synthetic_mets
+from bench_bookocr import write_synthetic_zip
+
+class DoesNotExist(Exception):
+    pass
+
+class MultipleObjectsReturned(Exception):
+    pass
+
+class Record:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+def _lookup(record, lookup, value):
+    # the subset of django field lookups the migration uses: exact, in, gte, lte
+    path = lookup.split('__')
+    op = path[-1] in ('exact', 'in', 'gte', 'lte') and path.pop() or 'exact'
+    for name in path:
+        record = getattr(record, name)
+    if isinstance(record, Record):
+        record = record.pk
+    if op == 'in':
+        return record in value
+    if op == 'gte':
+        return record >= value
+    if op == 'lte':
+        return record <= value
+    return record == value
+
+class QuerySet:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def filter(self, **lookups):
+        return QuerySet([row for row in self.rows if not [k for k, v in lookups.iteritems() if not _lookup(row, k, v)]])
+
+    def select_related(self, *fields):
+        return self
+
+    def get(self, **lookups):
+        rows = self.filter(**lookups).rows
+        if not rows:
+            raise DoesNotExist(repr(lookups))
+        if len(rows) > 1:
+            raise MultipleObjectsReturned(repr(lookups))
+        return rows[0]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+class Item(Record):
+    DoesNotExist = DoesNotExist
+    MultipleObjectsReturned = MultipleObjectsReturned
+    objects = QuerySet([])
+
+class Item_File(Record):
+    DoesNotExist = DoesNotExist
+    MultipleObjectsReturned = MultipleObjectsReturned
+    objects = QuerySet([])
+
+def shorten_string(s, length):
+    if len(s) <= length:
+        return s
+    return s[:length - 3] + '...'
+
+def get_roman_numeral(n):
+    numerals = ((1000, 'm'), (900, 'cm'), (500, 'd'), (400, 'cd'), (100, 'c'), (90, 'xc'),
+                (50, 'l'), (40, 'xl'), (10, 'x'), (9, 'ix'), (5, 'v'), (4, 'iv'), (1, 'i'))
+    roman = []
+    for value, numeral in numerals:
+        while n >= value:
+            roman.append(numeral)
+            n -= value
+    return ''.join(roman)
+
+def _module(name, **attributes):
+    module = sys.modules.get(name) or imp.new_module(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    parent, dot, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+def installModels():
+    """
+    Put the workflow model and drl.utils stand-ins in sys.modules; call before importing
+    migrate_drl_to_fedora.
+    """
+    _module('workflow')
+    _module('workflow.core')
+    _module('workflow.core.models', Item=Item, Item_File=Item_File)
+    _module('workflow.wflocal')
+    _module('workflow.wflocal.models')
+    _module('drl')
+    _module('drl.utils', shorten_string=shorten_string, get_roman_numeral=get_roman_numeral)
+
+def write_tiff(path, kb):
+    """
+    Write a little endian TIFF header followed by @kb KB of filler that differs between files.
+    """
+    f = open(path, 'wb')
+    f.write('II*\x00' + struct.pack('<I', 8))
+    filler = (path + '\x00') * (1024 / (len(path) + 1) + 1)
+    for n in range(kb):
+        f.write(filler[:1024])
+    f.close()
+
+def write_xml(path, root, text):
+    f = open(path, 'w')
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<%s><title>%s</title></%s>\n' % (root, text, root))
+    f.close()
+
+def write_thumb(path):
+    f = open(path, 'wb')
+    f.write('\xff\xd8\xff\xe0' + '\x00' * 2048 + '\xff\xd9')
+    f.close()
+
+def makeItem(workDir, collection, number, typeName, pages=1, tiffKb=1024, pageKb=4):
+    """
+    Write the files of one synthetic item of type @typeName to a directory of its own under
+    @workDir and add the item and its Item_File rows to the models.  Books get @pages page
+    TIFFs, METS, MARCXML and an OCR zip of @pageKb KB of text per page, manuscripts @pages page
+    TIFFs and METS, images and maps one master.  Returns the item.
+    """
+    doId = '%s%06d' % (collection, number)
+    itemDir = os.path.join(workDir, doId)
+    os.mkdir(itemDir)
+    item = Item(pk=len(Item.objects.rows) + 1, do_id=doId, name=u'Synthetic %s %d' % (typeName, number),
+                type=Record(name=typeName), primary_collection=Record(c_id=collection))
+    Item.objects.rows.append(item)
+
+    def addFile(use, name):
+        path = os.path.join(itemDir, name)
+        Item_File.objects.rows.append(Item_File(pk=len(Item_File.objects.rows) + 1, item=item, item_id=item.pk, use=use, name=name, path=path))
+        return path
+
+    write_xml(addFile('MODS', '%s.mods.xml' % doId), 'mods', item.name)
+    write_xml(addFile('DC', '%s.dc.xml' % doId), 'dc', item.name)
+    write_thumb(addFile('THUMB', '%s.thumb.jpg' % doId))
+    if typeName.startswith('text'):
+        write_xml(addFile('MARCXML', '%s.marc.xml' % doId), 'record', item.name)
+        write_synthetic_mets(addFile('METS', '%s.mets.xml' % doId), pages)
+        pageNames = write_synthetic_zip(addFile('OCR_ZIP', '%s.ocr.zip' % doId), pages, pageKb)
+        for name in pageNames:
+            write_tiff(addFile('MASTER', name), tiffKb)
+    elif typeName == 'manuscript':
+        write_synthetic_mets(addFile('METS', '%s.mets.xml' % doId), pages)
+        for n in range(1, pages + 1):
+            write_tiff(addFile('MASTER', '%08d.tif' % n), tiffKb)
+    else:
+        write_tiff(addFile('MASTER', '%s.tif' % doId), tiffKb)
+    return item
+
+def clearItems():
+    del Item.objects.rows[:]
+    del Item_File.objects.rows[:]
@@ -2,21 +2,32 @@
 import sys
 import os
 import zipfile
-import subprocess
-import shutil
-from lxml import etree 
+import hashlib
+import argparse
+import threading
+import itertools
+import multiprocessing
+import multiprocessing.dummy
 sys.path.append('/usr/local/dlxs/prep/w/workflow/lib')
 sys.path.append('/usr/local/dlxs/prep/w/workflow/django')
 os.environ["DJANGO_SETTINGS_MODULE"] = 'workflow.settings'
 import workflow.core.models
 import workflow.wflocal.models
 import drl.utils 
-import fcrepo.connection
-import fcrepo.client
 from islandoraUtils import fileConverter as converter
 from islandoraUtils import fedoraLib
 from islandoraUtils.metadata import fedora_relationships
-from utils.commonFedora import addObjectToFedora
+from utils.commonFedora import addObjectToFedora, connectToFedora, disconnectFromFedora, getConnectionPool, streamDatastream, ingestFoxml, getDatastreamChecksum, CHECKSUM_TYPE
+from utils.foxml import FoxmlDatastream, buildRelsExt, buildDc, streamFoxml
+from fcrepo.connection import FedoraConnectionException
+from utils.pipeline import Pipeline
+from utils.journal import MigrationJournal, COMPLETE
+from utils.derivatives import DerivativeEngine, MixExtractor, fileChecksum
+from utils.mets import getPageLabels
+from utils.ocr import OcrZip
+from utils.metrics import configure as configure_metrics, getMetrics, timed, profiled
+from utils.report import RunReport
+from utils.Mailer import SmtpTransport
 """
 Utility script to migrate digital objects from the legacy (as of 2012)
 DRL repository to Fedora.
@@ -53,6 +64,110 @@ ITEM_TYPE_CM_MAP = {
     'page': 'islandora:pageCModel'
 }
 
+FEDORA_URL = 'http://akira.library.pitt.edu:8080/fedora'
+FEDORA_USER = 'xxxxx'
+FEDORA_PASSWORD = 'xxxxx'
+# persistent connections each ingest process keeps to fedora, at least (see fedora_pool_size)
+FEDORA_POOL_SIZE = 4
+# create objects from FOXML that already holds their RELS-EXT, saving the separate update
+RELS_EXT_IN_CREATE = True
+
+# number of items ingest_collection migrates at once; 1 keeps the old serial behaviour
+INGEST_WORKERS = 1
+
+# concurrency of the page pipeline stages for books and manuscripts (see run_page_pipeline)
+PAGE_OBJECT_WORKERS = 2
+PAGE_JP2_WORKERS = 2
+PAGE_UPLOAD_WORKERS = 2
+# how many pages may wait in front of each page pipeline stage
+PAGE_QUEUE_SIZE = 4
+# how book pages are created: 'datastreams' creates each page object and then uploads its
+# datastreams one request at a time, 'foxml' ingests each page as a single FOXML document that
+# already holds its RELS-EXT and managed datastreams
+PAGE_INGEST_MODE = 'datastreams'
+# foxml mode: pages ingested back to back on one connection and journaled together
+PAGE_BATCH_SIZE = 20
+# foxml mode: if set, TIFF and JP2 content is referenced as PAGE_CONTENT_URL % local_path
+# (e.g. 'file://%s' when fedora can read the masters itself) instead of sent inline
+PAGE_CONTENT_URL = None
+
+# number of items whose Item_File rows are loaded with a single query
+MANIFEST_BATCH_SIZE = 100
+
+# jp2 derivatives: encoder backend (see utils.derivatives), how many encodes run at once, and
+# where encoded jp2s (and MIX) are cached for reruns and how large that cache may grow.  The
+# cache is off by default (None); a single pass over a collection never hits it
+JP2_ENCODER = 'dlxs'
+JP2_ENCODE_WORKERS = 2
+DERIVATIVE_CACHE_DIR = None
+DERIVATIVE_CACHE_MAX_BYTES = 20 * 1024 ** 3
+_derivative_engine = None
+
+# MIX technical metadata: jhove and its xslt, and how many jhove runs happen at once
+JHOVE_PATH = '/opt/jhove/jhove'
+JHOVE2MIX_XSLT = 'data/jhove2mix.xslt'
+MIX_WORKERS = 2
+_mix_extractor = None
+
+# local record of finished migration steps, used to resume interrupted runs
+JOURNAL_PATH = 'migration_journal.db'
+_journal = None
+
+# rerun items that were already migrated, pushing only the datastreams whose source files have
+# changed since (see sync_item)
+INCREMENTAL_SYNC = False
+
+# per-stage timing records (JSON lines, see utils.metrics) and seconds between the rolling
+# throughput summaries; None disables either
+METRICS_PATH = 'migration_metrics.jsonl'
+METRICS_SUMMARY_INTERVAL = 300
+_metrics_configured = False
+
+# run reports (see utils.report): the addresses they go to (none, no reports), seconds between
+# the summaries, and the SMTP server they are sent through (None sends them with mailx)
+REPORT_ADDRESSES = []
+REPORT_INTERVAL = 3600
+REPORT_SMTP_HOST = None
+REPORT_SMTP_PORT = 25
+REPORT_SENDER = 'drl-migration@localhost'
+
+# do_id of a single item to run under cProfile, its stats are written to PROFILE_DIR/<do_id>.prof
+PROFILE_ITEM = None
+PROFILE_DIR = '.'
+
+# dry run (plan_collection): threads checking the files, and the assumed jp2 encode speed of one
+# encoder in bytes of master tiff per second, used to estimate the encode time
+PLAN_WORKERS = 8
+PLAN_JP2_ENCODE_RATE = 10 * 1024 * 1024
+
+# fixity check (verify_collection): datastream checksums fetched from fedora at once
+VERIFY_WORKERS = 8
+
+# Item_File uses every item needs, and the ones its type needs on top (MASTER is checked
+# separately, books and manuscripts have one per page)
+BASE_FILE_USES = ('MODS', 'DC', 'THUMB')
+TYPE_FILE_USES = {
+    'image': (),
+    'map': (),
+    'text - cataloged': ('MARCXML', 'METS', 'OCR_ZIP'),
+    'text - uncataloged': ('MARCXML', 'METS', 'OCR_ZIP'),
+    'manuscript': ('METS',),
+}
+SINGLE_MASTER_TYPES = ('image', 'map')
+TEXT_TYPES = ('text - cataloged', 'text - uncataloged')
+
+# journal steps made from an Item_File, by use; MASTER is TIFF for images and every book page
+SOURCE_STEPS = (('MODS', 'MODS'), ('DC', 'DC'), ('THUMB', 'TN'), ('MARCXML', 'MARCXML'), ('METS', 'METS'))
+# steps derived from another step's source, redone along with it
+DERIVED_STEPS = {'TIFF': ('JP2', 'MIX')}
+# datastreams fedora keeps as inline xml, whatever they are sent as.  Fedora stores its own
+# serialization of the xml, so the checksum of what was sent never matches the one it computes;
+# none is journaled for them, and verify_collection passes over any an earlier run journaled
+INLINE_DATASTREAMS = ('DC',)
+
+# per-worker state (fedora client) for parallel collection ingest
+_worker_state = threading.local()
+
 def clean_page_labels(dict):
     cleaned_dict = {}
     for file in dict.keys():
@@ -74,20 +189,218 @@ def clean_page_labels(dict):
             
 
 def connect_to_fedora():
-    try:
-        connection = fcrepo.connection.Connection('http://akira.library.pitt.edu:8080/fedora', username='xxxxx', password='xxxxx')
-    except Exception as ex:
-        print 'Error while connecting to fedora: %s' % (ex.message,)
+    """
+    Return this worker's fedora client from the shared connection pool, or None if fedora
+    can't be reached.  The connection is made once per worker and reused for every item.
+    """
+    return connectToFedora(FEDORA_URL, FEDORA_USER, FEDORA_PASSWORD, poolSize=fedora_pool_size())
+
+def fedora_pool_size(workers=1):
+    """
+    The number of clients the pool of a process needs to migrate @workers items at once: one
+    for every item, and one for every page pipeline thread of its book that talks to fedora.
+    """
+    return max(FEDORA_POOL_SIZE, workers * (1 + PAGE_OBJECT_WORKERS + PAGE_UPLOAD_WORKERS))
+
+def page_stage_client():
+    """
+    Return the fedora client of the calling page pipeline thread.  An fcrepo client sends all
+    its requests over one http connection, so the stage threads can't share the item's client.
+    """
+    client = connect_to_fedora()
+    if client is None:
+        raise IOError("can't connect to fedora at %s" % (FEDORA_URL,))
+    return client
+
+def disconnect_from_fedora():
+    """
+    Give this thread's fedora client back to the pool.  Worker threads don't need to, their
+    clients are taken back once they have ended.
+    """
+    disconnectFromFedora(FEDORA_URL, FEDORA_USER)
+
+def get_journal():
+    """
+    Return the migration journal, opening JOURNAL_PATH on first use.  The journal object is safe
+    to share between threads and forked workers.
+    """
+    global _journal
+    if _journal is None:
+        _journal = MigrationJournal(JOURNAL_PATH)
+    return _journal
+
+def get_existing_journal():
+    """
+    get_journal, or None if there is no journal at JOURNAL_PATH yet; for the dry run, which must
+    not create one.
+    """
+    if _journal is None and not os.path.exists(JOURNAL_PATH):
         return None
+    return get_journal()
+
+def get_derivative_engine():
+    global _derivative_engine
+    if _derivative_engine is None:
+        _derivative_engine = DerivativeEngine(JP2_ENCODER, JP2_ENCODE_WORKERS, DERIVATIVE_CACHE_DIR, DERIVATIVE_CACHE_MAX_BYTES)
+    return _derivative_engine
+
+def get_mix_extractor():
+    global _mix_extractor
+    if _mix_extractor is None:
+        _mix_extractor = MixExtractor(MIX_WORKERS, DERIVATIVE_CACHE_DIR, JHOVE_PATH, JHOVE2MIX_XSLT, DERIVATIVE_CACHE_MAX_BYTES)
+    return _mix_extractor
+
+def get_metrics():
+    global _metrics_configured
+    if not _metrics_configured:
+        configure_metrics(METRICS_PATH, METRICS_SUMMARY_INTERVAL)
+        _metrics_configured = True
+    return getMetrics()
+
+def journal_step(pid, step, done, func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs) unless @step is in @done, the steps already journaled for @pid,
+    and journal the step once func has returned - unless it returned False, meaning the step
+    could not be done this time.  Returns whether the step is done.
+    """
+    if step in done:
+        return True
+    if func(*args, **kwargs) is False:
+        return False
+    get_journal().markDone(pid, step)
+    return True
 
+def stream_datastream(fedora_object, dsid, body, **kwargs):
+    """
+    streamDatastream, journaling the checksum of the content as it was sent so verify_collection
+    can check it against fedora without reading the source again (INLINE_DATASTREAMS excepted).
+    """
+    checksum, size = streamDatastream(fedora_object, dsid, body, **kwargs)
+    if dsid not in INLINE_DATASTREAMS:
+        get_journal().recordChecksum(fedora_object.pid, dsid, checksum, size, CHECKSUM_TYPE)
+
+def upload_file(fedora_object, dsid, path, label, mimeType, controlGroup='M'):
+    """
+    Stream the file at @path into datastream @dsid of fedora_object.
+    """
+    f = open(path, 'rb')
     try:
-        return fcrepo.client.FedoraClient(connection)
-    except Exception, ex:
-        print 'Exception while opening fedora client: %s' % (ex.message,)
-    return None
+        stream_datastream(fedora_object, dsid, f, label=label, mimeType=mimeType, controlGroup=controlGroup)
+    finally:
+        f.close()
+
+def update_datastream(fedora_object, dsid, path, label, mimeType, controlGroup='M'):
+    """
+    fedoraLib.update_datastream, timed.
+    """
+    with timed('fedora.update_datastream', bytes=os.path.getsize(path), pid=fedora_object.pid, dsid=dsid):
+        return fedoraLib.update_datastream(fedora_object, dsid, path, label=label, mimeType=mimeType, controlGroup=controlGroup)
+
+def get_collection_members(collection_id, types=None, do_id_range=None):
+    """
+    @param types: Only items whose type name is in this list
+    @param do_id_range: Only items with first <= do_id <= last, given as (first, last); either
+        end may be None
+    """
+    # primary_collection and type are needed for every item, fetch them in the same query
+    members = workflow.core.models.Item.objects.filter(primary_collection__c_id=collection_id).select_related('primary_collection', 'type')
+    if types:
+        members = members.filter(type__name__in=types)
+    if do_id_range:
+        first, last = do_id_range
+        if first:
+            members = members.filter(do_id__gte=first)
+        if last:
+            members = members.filter(do_id__lte=last)
+    return members
+
+def item_shard(do_id, shards):
+    """
+    Return the shard (0 .. shards-1) an item belongs to.  It depends on nothing but the do_id, so
+    every host running with the same number of shards agrees on it.
+    """
+    return int(hashlib.md5(do_id.encode('utf-8')).hexdigest(), 16) % shards
+
+class ItemFileManifest:
+    """
+    The Item_File rows of one item, indexed by use.  get() and filter() stand in for the
+    Item_File.objects queries the handlers used to make, without going back to the database.
+    """
+    def __init__(self):
+        self.files = {}
+
+    def add(self, item_file):
+        self.files.setdefault(item_file.use, []).append(item_file)
+
+    def get(self, use):
+        """
+        Return the one file with this use, raising Item_File.DoesNotExist or
+        MultipleObjectsReturned like Item_File.objects.get(item=item, use=use) would.
+        """
+        files = self.files.get(use, [])
+        if not files:
+            raise workflow.core.models.Item_File.DoesNotExist('no %s file' % (use,))
+        if len(files) > 1:
+            raise workflow.core.models.Item_File.MultipleObjectsReturned('%d %s files' % (len(files), use))
+        return files[0]
+
+    def filter(self, use):
+        """
+        Return every file with this use, ordered by name.
+        """
+        return sorted(self.files.get(use, []), key=lambda f: f.name)
+
+def load_file_manifests(items):
+    """
+    Fetch the Item_File rows of all @items with one query.  Returns a dict of item pk to
+    ItemFileManifest; items without any files get an empty manifest.
+    """
+    manifests = dict((item.pk, ItemFileManifest()) for item in items)
+    if manifests:
+        with timed('db.files', items=len(manifests)) as info:
+            item_files = list(workflow.core.models.Item_File.objects.filter(item__in=manifests.keys()))
+            info['rows'] = len(item_files)
+        for item_file in item_files:
+            manifests[item_file.item_id].add(item_file)
+    return manifests
+
+def iter_selected_members(collection_id, types=None, do_id_range=None, shard=None):
+    """
+    Iterate over the members of the collection, @types and @do_id_range as for
+    get_collection_members.  @shard (index, shards) keeps only the items item_shard puts in
+    shard index of shards.
+    """
+    members = iter(get_collection_members(collection_id, types, do_id_range))
+    if shard:
+        index, shards = shard
+        members = (item for item in members if item_shard(item.do_id, shards) == index)
+    return members
+
+def iter_collection_items(collection_id, types=None, do_id_range=None, shard=None):
+    """
+    Yield (item, ItemFileManifest) for every member of the collection selected as by
+    iter_selected_members, loading the manifests MANIFEST_BATCH_SIZE items at a time.  Items the
+    journal has as complete are skipped without their files, so they get None instead, unless
+    INCREMENTAL_SYNC compares them with their sources.
+    """
+    members = iter_selected_members(collection_id, types, do_id_range, shard)
+    journal = not INCREMENTAL_SYNC and get_existing_journal()
+    while True:
+        with timed('db.items', collection=collection_id) as info:
+            batch = list(itertools.islice(members, MANIFEST_BATCH_SIZE))
+            info['rows'] = len(batch)
+        if not batch:
+            return
+        needed = batch
+        if journal:
+            needed = [item for item in batch if not is_item_complete(journal, item)]
+        manifests = load_file_manifests(needed)
+        for item in batch:
+            yield item, manifests.get(item.pk)
 
-def get_collection_members(collection_id):
-    return workflow.core.models.Item.objects.filter(primary_collection__c_id=collection_id)
+def is_item_complete(journal, item):
+    ns = COLL_NS_MAP.get(item.primary_collection.c_id)
+    return ns is not None and journal.isDone(get_item_pid(item, ns), COMPLETE)
 
 def get_collection_namespace(item):
     return COLL_NS_MAP[item.primary_collection.c_id] 
@@ -95,77 +408,93 @@ def get_collection_namespace(item):
 def get_item_content_model(item):
     return ITEM_TYPE_CM_MAP[item.type.name]
 
+def get_item_pid(item, ns):
+    return '%s:%s' % (ns, item.do_id)
+
+class MissingFileError(Exception):
+    """
+    An item lacks a file it can't be migrated without.
+    """
+    pass
+
 def get_page_label_dict_from_mets(mets_path):
     """
     Parse the METS structMap to get proper page label
     """
-    METS_NS_MAP = {'mets': 'http://www.loc.gov/METS/'} 
-    mets = etree.parse(open(mets_path, 'r'))
-    labels = {}
-    for file in mets.iter('{http://www.loc.gov/METS/}file'):
-        file_id = file.get('ID')
-        file_name = file[0].get('{http://www.w3.org/1999/xlink}href')
-        xpath_string = '//mets:div[@TYPE="page"]/mets:fptr[@FILEID="%s"]' % (file_id,)
-        fptr = mets.xpath(xpath_string, namespaces=METS_NS_MAP)[0]
-        label = fptr.getparent().get('LABEL')
-        labels[file_name] = label
-    return labels
+    return getPageLabels(mets_path)
 
-def handle_base_object(fedora_client, item, ns, cm):
+def handle_base_object(fedora_client, item, ns, cm, files):
     """
     Create the base object record in Fedora, add common datastreams.
 
     @param item: The django item object from legacy workflow
     @param ns: The namespace to be used for the object's pid
     @param cm: The pid of the content model to be associated with the object
+    @param files: The ItemFileManifest of the item
 
     Other required data fields come from the item record itself: pid, label
 
+    Returns the fedora object, or False if the object or one of its datastreams couldn't be added.
     """
     print '%s - handle base object' % (item.do_id,)
     parent_pid = '%s:root' % (ns,)
-    pid = '%s:%s' % (ns, item.do_id)
+    pid = get_item_pid(item, ns)
     label = drl.utils.shorten_string(item.name, 245)
-    # if this object already exists, return (for now)
-    try:
-        obj = fedora_client.getObject(pid)
-        return obj 
-    except:
-        pass
-    # validate required objects, (for now) skip if not found
+    # the journal knows which steps earlier runs finished, an object that merely exists in
+    # fedora may still be missing datastreams
+    done = get_journal().doneSteps(pid)
+    # validate required objects, skip the item if one is missing
     try:
-        mods = workflow.core.models.Item_File.objects.get(item=item, use='MODS')
-        dc = workflow.core.models.Item_File.objects.get(item=item, use='DC')
-        thumb = workflow.core.models.Item_File.objects.get(item=item, use='THUMB')
-    except:
-        return
+        mods = files.get('MODS')
+        dc = files.get('DC')
+        thumb = files.get('THUMB')
+    except (workflow.core.models.Item_File.DoesNotExist, workflow.core.models.Item_File.MultipleObjectsReturned), ex:
+        raise MissingFileError(str(ex))
     try:
-        obj = addObjectToFedora(fedora_client, label, pid, parent_pid, cm)
+        if 'object' in done:
+            obj = fedora_client.getObject(pid)
+        else:
+            obj = addObjectToFedora(fedora_client, label, pid, parent_pid, cm, relsExtInCreate=RELS_EXT_IN_CREATE)
+            get_journal().markDone(pid, 'object')
     except Exception, ex:
         print 'connection error while trying to add fedora object %s: %s' % (pid, ex.message)
         return False
     # mods
-    mods = workflow.core.models.Item_File.objects.get(item=item, use='MODS')
-    fedoraLib.update_datastream(obj, u'MODS', mods.path, label=mods.name, mimeType=u'text/xml', controlGroup='X')
+    mods_done = journal_step(pid, 'MODS', done, update_datastream, obj, u'MODS', mods.path, label=mods.name, mimeType=u'text/xml', controlGroup='X')
     # dc
-    dc = workflow.core.models.Item_File.objects.get(item=item, use='DC')
-    fedoraLib.update_datastream(obj, u'DC', dc.path, label=dc.name, mimeType=u'text/xml', controlGroup='M')
+    dc_done = journal_step(pid, 'DC', done, upload_file, obj, u'DC', dc.path, label=dc.name, mimeType=u'text/xml', controlGroup='M')
     # thumb
-    thumb = workflow.core.models.Item_File.objects.get(item=item, use='THUMB')
-    fedoraLib.update_datastream(obj, u'TN', thumb.path, label=thumb.name, mimeType=u'image/jpeg', controlGroup='M')
+    tn_done = journal_step(pid, 'TN', done, upload_file, obj, u'TN', thumb.path, label=thumb.name, mimeType=u'image/jpeg', controlGroup='M')
+    if not (mods_done and dc_done and tn_done):
+        # the item must not be journaled as complete; the next run adds what is missing
+        print '%s - could not add every base datastream to %s' % (item.do_id, pid)
+        return False
     return obj
 
+def encode_jp2(tiff):
+    """
+    Encode (or fetch from the derivative cache) the JP2 of the tiff Item_File.  Returns a
+    utils.derivatives.Derivative, release() it once it has been uploaded.
+    """
+    with timed('encode.jp2', source_bytes=os.path.getsize(tiff.path), file=tiff.name):
+        return get_derivative_engine().encodeJp2(tiff.path)
+
+def wait_for_mix(mix, tiff):
+    """
+    Return the MIX xml of a pending extraction, raising RuntimeError if jhove failed.
+    """
+    with timed('mix.wait', file=tiff.name):
+        return mix.get()
+
+def upload_derived_jp2(fedora_object, tiff, jp2):
+    try:
+        jp2_label = '%s.jp2' % (os.path.splitext(tiff.name)[0],)
+        upload_file(fedora_object, u"JP2", jp2.path, label=jp2_label, mimeType=u'image/jp2', controlGroup='M')
+    finally:
+        jp2.release() # finished with that
+
 def handle_derived_jp2(fedora_object, tiff):
-    baseName = os.path.splitext(tiff.name)[0]
-    #jp2_file = os.path.join('/tmp', '%s.jp2' % (baseName,))
-    #converter.tif_to_jp2(tiff.path, jp2_file, 'default', 'default')
-    shutil.copy(tiff.path, '/tmp/')
-    jp2_source = os.path.join('/tmp', tiff.name)
-    encoder = '/usr/local/dlxs/prep/i/image/encodeJp2'
-    jp2_file = subprocess.Popen([encoder, jp2_source], stdout=subprocess.PIPE).communicate()[0].strip()
-    os.remove(jp2_source)
-    fedoraLib.update_datastream(fedora_object, u"JP2", jp2_file, label=os.path.basename(jp2_file), mimeType=u'image/jp2', controlGroup='M')
-    os.remove(jp2_file) # finished with that
+    upload_derived_jp2(fedora_object, tiff, encode_jp2(tiff))
     return
 
 """
@@ -183,153 +512,897 @@ def handle_derived_pdf(fedora_object, tiff):
     #os.remove(pdf_file)
     return
 
-def handle_derived_mix(fedora_object, tiff):
+def handle_derived_mix(fedora_object, tiff, mix=None):
     """
     Extract MIX metadata from the input tiff file
+    @param mix: The pending result of get_mix_extractor().submit(tiff.path), if extraction was
+        already started; otherwise it is done here
+    Returns False if jhove failed, so the step is tried again on the next run.
     """
-    basename = os.path.splitext(tiff.name)[0]
-    mix_file = os.path.join("/tmp", "%s.mix.xml" % baseName)
-    out_file = open(mix_file, "w")
-    #cmd= jhove -h xml $INFILE | xsltproc jhove2mix.xslt - > `basename ${$INFILE%.*}.mix`
-    jhoveCmd1 = ["/opt/jhove/jhove", "-h", "xml", tiff.name]
-    jhoveCmd2 = ["xsltproc", "data/jhove2mix.xslt", "-"] # complete cmd for xsltproc
-    #jhoveCmd2 = ["xalan", "-xsl", "data/jhove2mix.xslt"] # complete cmd for xalan
-    p1 = subprocess.Popen(jhoveCmd1, stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(jhoveCmd2, stdin=p1.stdout, stdout=out_file)
-    r = p2.communicate()
-    if os.path.getsize(mix_file) == 0:
+    if mix is None:
+        mix = get_mix_extractor().submit(tiff.path)
+    try:
+        mix_xml = wait_for_mix(mix, tiff)
+    except RuntimeError, ex:
         # failed for some reason
-        print("jhove conversion failed")
-    else:
-        fedoraLib.update_datastream(fedora_object, u"MIX", mix_file, label=os.path.basename(mix_file), mimeType=misc.getMimeType("xml"))
-    out_file.close()
-    """ end extract """
-    os.remove(mix_file) # finished with that
+        print '%s' % (ex,)
+        return False
+    mix_label = '%s.mix.xml' % (os.path.splitext(tiff.name)[0],)
+    stream_datastream(fedora_object, u"MIX", mix_xml, label=mix_label, mimeType=u'text/xml', controlGroup='M')
     return
 
-def handle_image_object(fedora_object, item):
+def handle_image_object(fedora_object, item, files):
     print '%s - handle image object' % (item.do_id,)
     # tiff image file
-    tiff = workflow.core.models.Item_File.objects.get(item=item, use='MASTER')
-    fedoraLib.update_datastream(fedora_object, 'TIFF', tiff.path, label=tiff.name, mimeType='image/tiff', controlGroup='M')
-    handle_derived_jp2(fedora_object, tiff)
-    #handle_derived_mix(fedora_object, tiff)
+    tiff = files.get('MASTER')
+    done = get_journal().doneSteps(fedora_object.pid)
+    # jhove runs while the tiff and jp2 are dealt with
+    mix = 'MIX' not in done and get_mix_extractor().submit(tiff.path) or None
+    journal_step(fedora_object.pid, 'TIFF', done, upload_file, fedora_object, 'TIFF', tiff.path, label=tiff.name, mimeType='image/tiff', controlGroup='M')
+    journal_step(fedora_object.pid, 'JP2', done, handle_derived_jp2, fedora_object, tiff)
+    finished = journal_step(fedora_object.pid, 'MIX', done, handle_derived_mix, fedora_object, tiff, mix)
     try:
-        kml = workflow.core.models.Item_File.objects.get(item=item, use='KML')
+        kml = files.get('KML')
         # activate this when ready
         # fedoraLib.update_datastream(fedora_object, 'KML', kml.path, label=kml.name, mimeType='text/xml', controlGroup='M')
     except:
-        return 
-    return 
+        return finished
+    return finished
 
-def handle_text_object(fedora_client, fedora_object, item):
+class PageJob:
+    """
+    One book page travelling through the page pipeline of handle_text_object.
+    """
+    def __init__(self, page, label, ocr_zip, ocr_info, pid, done):
+        self.page = page
+        self.label = label
+        # the page's member of the book's ocr zip, if it has one
+        self.ocr_zip = ocr_zip
+        self.ocr_info = ocr_info
+        self.pid = pid
+        # steps the journal has already recorded for this page
+        self.done = done
+        self.page_object = None
+        self.jp2 = None
+        # pending MIX extraction, started as soon as the page enters the pipeline
+        self.mix = None
+        # DC generated for the page, for pages without a DC file of their own (manuscripts)
+        self.dc = None
+        self.complete = False
+
+def handle_text_object(fedora_client, fedora_object, item, files):
     print '%s - handle text object' % (item.do_id,)
+    journal = get_journal()
+    done = journal.doneSteps(fedora_object.pid)
     # marcxml
-    marcxml = workflow.core.models.Item_File.objects.get(item=item, use='MARCXML')
-    fedoraLib.update_datastream(fedora_object, u'MARCXML', marcxml.path, label=marcxml.name, mimeType=u'text/xml', controlGroup='M')
+    marcxml = files.get('MARCXML')
+    journal_step(fedora_object.pid, 'MARCXML', done, upload_file, fedora_object, u'MARCXML', marcxml.path, label=marcxml.name, mimeType=u'text/xml', controlGroup='M')
     # mets 
-    mets = workflow.core.models.Item_File.objects.get(item=item, use='METS')
-    fedoraLib.update_datastream(fedora_object, u'METS', mets.path, label=mets.name, mimeType=u'text/xml', controlGroup='M')
-    # ocr zip
-    ocr_zipfile = workflow.core.models.Item_File.objects.get(item=item, use='OCR_ZIP')
-    ocr_zip = zipfile.ZipFile(ocr_zipfile.path, 'r')
-    # master pdf and ocr
-    book_PDF_filename = os.path.join("/tmp", "%s.pdf" % item.do_id) 
-    book_OCR_filename = os.path.join("/tmp", "%s-full.ocr" % item.do_id)
-    ocr_page_list = []
+    mets = files.get('METS')
+    journal_step(fedora_object.pid, 'METS', done, upload_file, fedora_object, u'METS', mets.path, label=mets.name, mimeType=u'text/xml', controlGroup='M')
+    # ocr zip, its members are indexed once here
+    ocr_zipfile = files.get('OCR_ZIP')
+    ocr_zip = OcrZip(ocr_zipfile.path)
     # pages
     page_label_dict = get_page_label_dict_from_mets(mets.path)
     cleaned_page_labels = clean_page_labels(page_label_dict)
-    pages = workflow.core.models.Item_File.objects.filter(item=item, use='MASTER').order_by('name')
+    pages = files.filter('MASTER')
+
+    def page_ocr_infos():
+        # zip members of the pages' ocr in page order, BOOKOCR is streamed from these
+        for page in pages:
+            ocr_info = ocr_zip.pageInfo(page.name)
+            if ocr_info:
+                yield ocr_info
+
+    try:
+        page_results = run_page_pipeline(fedora_object, iter_page_jobs(fedora_object, pages, cleaned_page_labels, ocr_zip))
+
+        if 'BOOKOCR' not in done:
+            # the pages' text is sent straight from the zip block by block, the book is never
+            # held in memory
+            book_ocr_length = sum(info.file_size for info in page_ocr_infos())
+            stream_datastream(fedora_object, u"BOOKOCR", ocr_zip.iterText(page_ocr_infos()), label=u'%s-full.ocr' % (item.do_id,), mimeType="text/plain", length=book_ocr_length)
+            journal.markDone(fedora_object.pid, 'BOOKOCR')
+    finally:
+        ocr_zip.close()
+
+    # False leaves the book to be finished by the next run
+    return not [job for job in page_results if not job.complete]
+
+def iter_page_jobs(fedora_object, pages, page_labels, ocr_zip=None, page_dc=False):
+    """
+    Yield a PageJob for every page of @pages (MASTER Item_Files) the journal doesn't have as
+    complete, starting its MIX extraction.  @page_labels maps page file names to labels, as
+    from clean_page_labels.  @ocr_zip is the OcrZip of the book's OCR, if it has any; with
+    @page_dc every page gets a generated DC datastream.
+    """
+    journal = get_journal()
     for page in pages:
-        ocr_filename = '%s.txt' % (os.path.splitext(page.name)[0],)
-        ocr_path = None # initalize
-        if ocr_filename in ocr_zip.namelist():
-            ocr_file = ocr_zip.extract(ocr_filename, '/tmp') 
-            ocr_path = os.path.join('/tmp', ocr_filename) 
-            # add this page's ocr to the running total
-            f = open(ocr_path, 'r')
-            ocr_page_list.append(f.read())
-            f.close()
-        page_label = cleaned_page_labels[page.name]
-        handle_page_object(fedora_client, fedora_object, page, ocr_path, page_label)
-        if ocr_path:
-            os.remove(ocr_path)
-
-    ocr_book_data = ''.join(ocr_page_list)
-    f = open(book_OCR_filename, "w")
-    f.write(ocr_book_data)
-    f.close()
-    fedoraLib.update_datastream(fedora_object, u"BOOKOCR", book_OCR_filename, label=unicode(os.path.basename(book_OCR_filename)), mimeType="text/plain")
-    os.remove(book_OCR_filename)
+        page_pid = get_page_pid(fedora_object, page)
+        page_done = journal.doneSteps(page_pid)
+        if COMPLETE in page_done:
+            continue
+        ocr_info = ocr_zip and ocr_zip.pageInfo(page.name)
+        job = PageJob(page, page_labels[page.name], ocr_zip, ocr_info, page_pid, page_done)
+        if page_dc:
+            page_label = get_page_properties(fedora_object, page, job.label)[1]
+            job.dc = buildDc(page_pid, page_label, fedora_object.pid)
+        if 'MIX' not in page_done:
+            job.mix = get_mix_extractor().submit(page.path)
+        yield job
 
-    return
+def run_page_pipeline(fedora_object, jobs):
+    """
+    Run the PageJobs of a book or manuscript through the page pipeline and return them.  Page
+    objects are created, jp2s encoded and datastreams uploaded at the same time for different
+    pages, each stage on its own bounded number of threads (PAGE_*_WORKERS), with at most
+    PAGE_QUEUE_SIZE pages waiting in front of a stage.  Every stage thread that talks to
+    fedora uses a pooled client of its own (see fedora_pool_size).
+    """
+    pipeline = Pipeline(queueSize=PAGE_QUEUE_SIZE)
+    if PAGE_INGEST_MODE == 'foxml':
+        pipeline.addStage('page-jp2', encode_page_job_jp2, PAGE_JP2_WORKERS)
+        pipeline.addBatchStage('page-ingest', lambda jobs: ingest_page_batch(page_stage_client(), fedora_object, jobs), PAGE_BATCH_SIZE, PAGE_UPLOAD_WORKERS)
+    else:
+        pipeline.addStage('page-object', lambda job: create_page_job_object(page_stage_client(), fedora_object, job), PAGE_OBJECT_WORKERS)
+        pipeline.addStage('page-jp2', encode_page_job_jp2, PAGE_JP2_WORKERS)
+        pipeline.addStage('page-upload', upload_page_job, PAGE_UPLOAD_WORKERS)
+    return pipeline.run(jobs)
 
-def handle_map_object(fedora_object, item):
+def handle_map_object(fedora_object, item, files):
     print '%s - handle map object' % (item.do_id,)
     # tiff image file
-    tiff = workflow.core.models.Item_File.objects.get(item=item, use='MASTER')
-    fedoraLib.update_datastream(fedora_object, 'TIFF', tiff.path, label=tiff.name, mimeType='image/tiff', controlGroup='M')
-    handle_derived_jp2(fedora_object, tiff)
-    return
+    tiff = files.get('MASTER')
+    done = get_journal().doneSteps(fedora_object.pid)
+    mix = 'MIX' not in done and get_mix_extractor().submit(tiff.path) or None
+    journal_step(fedora_object.pid, 'TIFF', done, upload_file, fedora_object, 'TIFF', tiff.path, label=tiff.name, mimeType='image/tiff', controlGroup='M')
+    journal_step(fedora_object.pid, 'JP2', done, handle_derived_jp2, fedora_object, tiff)
+    return journal_step(fedora_object.pid, 'MIX', done, handle_derived_mix, fedora_object, tiff, mix)
 
-def handle_manuscript_object(fedora_object, item):
+def handle_manuscript_object(fedora_client, fedora_object, item, files):
+    """
+    A manuscript is a book without OCR or MARCXML: its METS, and a page object for every page
+    image with TIFF, JP2, MIX and a DC generated from the page label.
+    """
     print '%s - handle manuscript object' % (item.do_id,)
+    done = get_journal().doneSteps(fedora_object.pid)
     # mets
-    # for each page:
-        # tiff page image file
-        # dc
+    mets = files.get('METS')
+    journal_step(fedora_object.pid, 'METS', done, upload_file, fedora_object, u'METS', mets.path, label=mets.name, mimeType=u'text/xml', controlGroup='M')
+    # pages
+    page_labels = clean_page_labels(get_page_label_dict_from_mets(mets.path))
+    pages = files.filter('MASTER')
+    page_results = run_page_pipeline(fedora_object, iter_page_jobs(fedora_object, pages, page_labels, page_dc=True))
+    # False leaves the manuscript to be finished by the next run
+    return not [job for job in page_results if not job.complete]
+
+def get_page_pid(fedora_object, page):
+    return get_page_pid_for(fedora_object.pid, page)
 
-def handle_page_object(fedora_client, fedora_object, page, ocr_path, label):
+def get_page_pid_for(book_pid, page):
+    return '%s-%s' % (book_pid, os.path.splitext(page.name)[0])
+
+def get_page_properties(fedora_object, page, label):
     """
-    The page object gets some extra relationships as a member of a book object.
-    It should also get:
-        - MODS (this should be based on parent book mods, but with page label from METS structmap)
-        - JP2 (derived from TIFF)
-        - MIX
-        - OCR, if available
+    Returns (page_pid, page_label, extraNamespaces, extraRelationships) of a book page object.
     """
-    page_cm = ITEM_TYPE_CM_MAP['page']
     page_basename = os.path.splitext(page.name)[0]
-    page_pid = '%s-%s' % (fedora_object.pid, page_basename)
+    page_pid = get_page_pid(fedora_object, page)
     page_label = u'%s, %s' % (label, drl.utils.shorten_string(fedora_object.label, 205))
     extraNamespaces = { 'pageNS' : 'info:islandora/islandora-system:def/pageinfo#' }
     # should the page number be a counter here instead of int(page_basename)?
     extraRelationships = { fedora_relationships.rels_predicate('pageNS', 'isPageNumber') : str(int(page_basename)),
                            fedora_relationships.rels_predicate('pageNS', 'isPageOf') : str(fedora_object.pid) }
-    page_object = addObjectToFedora(fedora_client, page_label, page_pid, fedora_object.pid, page_cm, extraNamespaces=extraNamespaces, extraRelationships=extraRelationships)
-    fedoraLib.update_datastream(page_object, 'TIFF', page.path, label=page.name, mimeType='image/tiff', controlGroup='M')
-    handle_derived_jp2(page_object, page)
-    #handle_derived_mix(page_object, page)
-    if ocr_path:
-        ocr_filename = os.path.basename(ocr_path) 
-        fedoraLib.update_datastream(page_object, u'OCR', ocr_path, label=unicode(ocr_filename), mimeType=u'text/plain', controlGroup='M')
+    return page_pid, page_label, extraNamespaces, extraRelationships
+
+def create_page_object(fedora_client, fedora_object, page, label):
+    page_cm = ITEM_TYPE_CM_MAP['page']
+    page_pid, page_label, extraNamespaces, extraRelationships = get_page_properties(fedora_object, page, label)
+    return addObjectToFedora(fedora_client, page_label, page_pid, fedora_object.pid, page_cm, extraNamespaces=extraNamespaces, extraRelationships=extraRelationships, relsExtInCreate=RELS_EXT_IN_CREATE)
+
+def upload_page_datastreams(page_object, page, ocr_zip, ocr_info, done=(), dc=None):
+    journal_step(page_object.pid, 'TIFF', done, upload_file, page_object, 'TIFF', page.path, label=page.name, mimeType='image/tiff', controlGroup='M')
+    if dc:
+        journal_step(page_object.pid, 'DC', done, stream_datastream, page_object, u'DC', dc, label=u'%s.dc.xml' % (os.path.splitext(page.name)[0],), mimeType=u'text/xml', controlGroup='M')
+    if ocr_info and 'OCR' not in done:
+        # straight out of the zip, no need to extract it first
+        ocr_file = ocr_zip.open(ocr_info)
+        try:
+            journal_step(page_object.pid, 'OCR', done, stream_datastream, page_object, u'OCR', ocr_file, label=unicode(ocr_info.filename), mimeType=u'text/plain', controlGroup='M', length=ocr_info.file_size)
+        finally:
+            ocr_file.close()
+
+""" page pipeline stages, used by handle_text_object; each one takes and returns a PageJob """
+
+def create_page_job_object(fedora_client, fedora_object, job):
+    if 'object' in job.done:
+        job.page_object = fedora_client.getObject(job.pid)
+    else:
+        job.page_object = create_page_object(fedora_client, fedora_object, job.page, job.label)
+        get_journal().markDone(job.pid, 'object')
+    return job
+
+def encode_page_job_jp2(job):
+    if 'JP2' not in job.done:
+        job.jp2 = encode_jp2(job.page)
+    return job
+
+def upload_page_job(job):
+    try:
+        # the page object was loaded on a page-object thread, through that thread's client
+        job.page_object.client = page_stage_client()
+        upload_page_datastreams(job.page_object, job.page, job.ocr_zip, job.ocr_info, job.done, job.dc)
+        journal_step(job.pid, 'JP2', job.done, upload_derived_jp2, job.page_object, job.page, job.jp2)
+    finally:
+        # a no-op once upload_derived_jp2 has released it
+        if job.jp2:
+            job.jp2.release()
+    if journal_step(job.pid, 'MIX', job.done, handle_derived_mix, job.page_object, job.page, job.mix):
+        get_journal().markDone(job.pid, COMPLETE)
+        job.complete = True
+    return job
+
+def page_content_datastream(dsid, label, mimeType, path):
+    if PAGE_CONTENT_URL:
+        return FoxmlDatastream.fromUrl(dsid, label, mimeType, PAGE_CONTENT_URL % (path,))
+    return FoxmlDatastream.fromFile(dsid, label, mimeType, path)
+
+def ingest_page_foxml(fedora_client, fedora_object, job):
+    """
+    Create the page object of @job, with its RELS-EXT, TIFF, JP2, OCR, DC and MIX, in one FOXML
+    ingest.  Returns the journal steps that are now done and the (pid, dsid, checksum, size) of
+    the content sent, or None if the page object already existed (and nothing was changed).
+    """
+    page = job.page
+    page_pid, page_label, extraNamespaces, extraRelationships = get_page_properties(fedora_object, page, job.label)
+    rels_ext = buildRelsExt(page_pid, ITEM_TYPE_CM_MAP['page'], fedora_object.pid, extraNamespaces, extraRelationships)
+    datastreams = [page_content_datastream('TIFF', page.name, 'image/tiff', page.path),
+                   page_content_datastream('JP2', '%s.jp2' % (os.path.splitext(page.name)[0],), 'image/jp2', job.jp2.path)]
+    steps = ['object', 'TIFF', 'JP2']
+    if job.ocr_info:
+        ocr_zip, ocr_info = job.ocr_zip, job.ocr_info
+        datastreams.append(FoxmlDatastream.fromStream('OCR', ocr_info.filename, 'text/plain', lambda: ocr_zip.open(ocr_info), ocr_info.file_size))
+        steps.append('OCR')
+    if job.dc:
+        datastreams.append(FoxmlDatastream.fromString('DC', '%s.dc.xml' % (os.path.splitext(page.name)[0],), 'text/xml', job.dc))
+        steps.append('DC')
+    mix = job.mix or get_mix_extractor().submit(page.path)
+    try:
+        mix_label = '%s.mix.xml' % (os.path.splitext(page.name)[0],)
+        datastreams.append(FoxmlDatastream.fromString('MIX', mix_label, 'text/xml', wait_for_mix(mix, page)))
+        steps.extend(['MIX', COMPLETE])
+    except RuntimeError, ex:
+        # the page is created without it; MIX is added by the next run
+        print '%s' % (ex,)
+    body, length = streamFoxml(page_pid, page_label, rels_ext, datastreams)
+    try:
+        ingestFoxml(fedora_client, page_pid, body, length, returnObject=False)
+    except FedoraConnectionException, ex:
+        if 'ObjectExistsException' in str(ex.body):
+            return None
+        raise
+    checksums = [(page_pid, ds.dsid, ds.checksum, ds.size) for ds in datastreams if ds.checksum and ds.dsid not in INLINE_DATASTREAMS]
+    return steps, checksums
+
+def ingest_page_batch(fedora_client, fedora_object, jobs):
+    """
+    Batch stage of the foxml page pipeline: ingest each page of the batch as one FOXML document
+    and journal the whole batch in one go.  Pages an earlier run already started, and pages that
+    turn out to exist in fedora, are finished datastream by datastream instead.  When a page
+    fails, the pages ingested before it are still journaled and the jp2s of the rest released.
+    """
+    finished = []
+    checksums = []
+    try:
+        for job in jobs:
+            ingested = None
+            if 'object' not in job.done and job.jp2:
+                ingested = ingest_page_foxml(fedora_client, fedora_object, job)
+                if ingested is None:
+                    # ingested by a run that stopped before journaling it
+                    job.done.add('object')
+            if ingested is None:
+                create_page_job_object(fedora_client, fedora_object, job)
+                upload_page_job(job)
+                continue
+            job.jp2.release()
+            steps, page_checksums = ingested
+            finished.extend([(job.pid, step) for step in steps])
+            checksums.extend(page_checksums)
+            job.complete = COMPLETE in steps
+    except:
+        # releasing is a no-op for the jp2s already uploaded
+        for job in jobs:
+            if job.jp2:
+                job.jp2.release()
+        raise
+    finally:
+        # otherwise the next run would find the pages already ingested in fedora and redo them
+        # datastream by datastream
+        journal = get_journal()
+        journal.recordChecksums(checksums, CHECKSUM_TYPE)
+        journal.markDoneMany(finished)
+    return jobs
+
+
+""" dry run """
+
+def object_http_calls():
+    # the existence check, then ingest and fetch, or create plus RELS-EXT read and write
+    return RELS_EXT_IN_CREATE and 3 or 4
+
+def plan_item(item, files):
+    """
+    Work out what ingest_item would do for @item without touching fedora: check that its
+    namespace, content model and files are all there, and count the bytes, pages, http requests
+    and jp2 encodes it needs.  Returns a dict; 'problems' lists everything that would make the
+    item fail, 'complete' is True if the journal says it has already been migrated.
+    """
+    type = item.type.name
+    plan = {'do_id': item.do_id, 'type': type, 'complete': False, 'problems': [], 'bytes': 0,
+            'pages': 0, 'http_calls': 0, 'encodes': 0, 'encode_bytes': 0}
+    problems = plan['problems']
+    journal = get_existing_journal()
+    ns = COLL_NS_MAP.get(item.primary_collection.c_id)
+    if ns is None:
+        problems.append('collection %s has no namespace in COLL_NS_MAP' % (item.primary_collection.c_id,))
+    elif journal and journal.isDone(get_item_pid(item, ns), COMPLETE):
+        plan['complete'] = True
+        return plan
+    if type not in ITEM_TYPE_CM_MAP:
+        problems.append('type %s has no content model in ITEM_TYPE_CM_MAP' % (type,))
+
+    def file_size(item_file):
+        try:
+            return os.stat(item_file.path).st_size
+        except OSError, ex:
+            problems.append('%s file %s: %s' % (item_file.use, item_file.path, ex.strerror))
+            return 0
+
+    found = {}
+    for use in BASE_FILE_USES + TYPE_FILE_USES.get(type, ()):
+        try:
+            found[use] = files.get(use)
+        except (workflow.core.models.Item_File.DoesNotExist, workflow.core.models.Item_File.MultipleObjectsReturned), ex:
+            problems.append(str(ex))
+    for use in BASE_FILE_USES + ('MARCXML', 'METS'):
+        if use in found:
+            plan['bytes'] += file_size(found[use])
+    masters = files.filter('MASTER')
+    if not masters:
+        problems.append('no MASTER file')
+    elif type in SINGLE_MASTER_TYPES and len(masters) > 1:
+        problems.append('%d MASTER files' % (len(masters),))
+    for master in masters:
+        size = file_size(master)
+        plan['bytes'] += size
+        plan['encode_bytes'] += size
+    plan['encodes'] = len(masters)
+
+    # MODS, DC, TN
+    calls = object_http_calls() + 3
+    if type in SINGLE_MASTER_TYPES:
+        # TIFF, JP2, MIX
+        calls += 3
+    elif type in ('text - cataloged', 'text - uncataloged'):
+        # MARCXML, METS, BOOKOCR
+        calls += 3
+        plan['pages'] = len(masters)
+        ocr_zip = None
+        if 'OCR_ZIP' in found:
+            try:
+                ocr_zip = OcrZip(found['OCR_ZIP'].path)
+            except (IOError, zipfile.BadZipfile), ex:
+                problems.append('OCR_ZIP file %s: %s' % (found['OCR_ZIP'].path, ex))
+        for master in masters:
+            ocr_info = ocr_zip and ocr_zip.pageInfo(master.name)
+            if ocr_info:
+                # sent once as the page's OCR and once more inside BOOKOCR
+                plan['bytes'] += 2 * ocr_info.file_size
+            if PAGE_INGEST_MODE == 'foxml':
+                calls += 1
+            else:
+                # TIFF, JP2, MIX and the OCR if there is one
+                calls += object_http_calls() + 3
+                if ocr_info:
+                    calls += 1
+        if ocr_zip:
+            ocr_zip.close()
+    elif type == 'manuscript':
+        # METS
+        calls += 1
+        plan['pages'] = len(masters)
+        if PAGE_INGEST_MODE == 'foxml':
+            calls += len(masters)
+        else:
+            # TIFF, JP2, MIX and DC
+            calls += len(masters) * (object_http_calls() + 4)
+    plan['http_calls'] = calls
+    return plan
+
+def _plan_item_worker(args):
+    item, files = args
+    try:
+        return plan_item(item, files)
+    except Exception, ex:
+        return {'do_id': item.do_id, 'type': item.type.name, 'complete': False, 'problems': ['%s: %s' % (ex.__class__.__name__, ex)],
+                'bytes': 0, 'pages': 0, 'http_calls': 0, 'encodes': 0, 'encode_bytes': 0}
+
+def plan_collection(collection_id, types=None, do_id_range=None, shard=None, workers=None):
+    """
+    Dry run of ingest_collection: plan_item every member (the file checks run on @workers
+    threads, PLAN_WORKERS if not given), print the totals and every item with problems, and return the totals as a dict.
+    Nothing is created in fedora and nothing is journaled; the journal is only read, if there is
+    one, to count the items already migrated.  The encode time assumes PLAN_JP2_ENCODE_RATE and
+    JP2_ENCODE_WORKERS encoders, and ignores the derivative cache.
+    """
+    if workers is None:
+        workers = PLAN_WORKERS
+    totals = {'items': 0, 'complete': 0, 'failing': 0, 'bytes': 0, 'pages': 0, 'http_calls': 0, 'encodes': 0, 'encode_bytes': 0}
+    failing = []
+    # open the journal, if there is one, before the threads all try to
+    get_existing_journal()
+    pool = multiprocessing.dummy.Pool(workers)
+    try:
+        for plan in pool.imap(_plan_item_worker, iter_collection_items(collection_id, types, do_id_range, shard)):
+            totals['items'] += 1
+            if plan['complete']:
+                totals['complete'] += 1
+                continue
+            if plan['problems']:
+                totals['failing'] += 1
+                failing.append(plan)
+            for key in ('bytes', 'pages', 'http_calls', 'encodes', 'encode_bytes'):
+                totals[key] += plan[key]
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    totals['encode_seconds'] = totals['encode_bytes'] / float(PLAN_JP2_ENCODE_RATE * max(1, JP2_ENCODE_WORKERS))
+
+    print '%s - %d items, %d already migrated, %d with problems' % (collection_id, totals['items'], totals['complete'], totals['failing'])
+    print '%s - %.2f GB to send (not counting derivatives), %d pages, about %d http requests' % (collection_id, totals['bytes'] / 1024.0 ** 3, totals['pages'], totals['http_calls'])
+    print '%s - %d jp2 encodes of %.2f GB of tiff, about %.1f hours with %d encoders' % (collection_id, totals['encodes'], totals['encode_bytes'] / 1024.0 ** 3, totals['encode_seconds'] / 3600, JP2_ENCODE_WORKERS)
+    for plan in failing:
+        print '%s - %s' % (plan['do_id'], '; '.join(plan['problems']))
+    return totals
+
+""" fixity """
+
+def verify_datastream(args):
+    """
+    Compare the checksum journaled for one datastream, (pid, dsid, type, checksum, size), with
+    the one fedora holds.  Returns (pid, dsid, problem), problem None when they match.
+    """
+    pid, dsid, type, checksum, size = args
+    fedora_client = _get_worker_fedora_client()
+    if not fedora_client:
+        return (pid, dsid, 'could not connect to fedora')
+    try:
+        with timed('fedora.checksum', pid=pid, dsid=dsid):
+            fedora_type, fedora_checksum = getDatastreamChecksum(fedora_client, pid, dsid)
+    except FedoraConnectionException, ex:
+        return (pid, dsid, 'fedora error %s' % (ex.httpcode,))
+    if fedora_checksum == 'none':
+        return (pid, dsid, 'fedora keeps no checksum')
+    if fedora_type.upper() != type.upper():
+        return (pid, dsid, 'fedora keeps a %s checksum, %s was recorded' % (fedora_type, type))
+    if fedora_checksum.lower() != checksum.lower():
+        return (pid, dsid, 'checksum mismatch, sent %s, fedora has %s' % (checksum, fedora_checksum))
+    return (pid, dsid, None)
+
+def verify_collection(collection_id, types=None, do_id_range=None, shard=None, workers=None):
+    """
+    Fixity check: compare the checksums journaled while the collection's datastreams were sent
+    (pages included) with the checksums fedora computed for them.  At most @workers datastream
+    profiles (VERIFY_WORKERS if not given) are fetched at once; the source files aren't read
+    again.  Prints and returns the list of (pid, dsid, problem) that didn't match.
+    """
+    if workers is None:
+        workers = VERIFY_WORKERS
+    # every verify thread keeps its own pooled client
+    getConnectionPool(FEDORA_URL, FEDORA_USER, FEDORA_PASSWORD, max(FEDORA_POOL_SIZE, workers))
+    get_metrics()
+    journal = get_journal()
+    counts = {'items': 0, 'unrecorded': 0}
+
+    def recorded_checksums():
+        for item in iter_selected_members(collection_id, types, do_id_range, shard):
+            counts['items'] += 1
+            ns = COLL_NS_MAP.get(item.primary_collection.c_id)
+            rows = ns and journal.checksums(get_item_pid(item, ns), children=True) or []
+            rows = [row for row in rows if row[1] not in INLINE_DATASTREAMS]
+            if not rows:
+                counts['unrecorded'] += 1
+            for row in rows:
+                yield row
 
+    checked = 0
+    failures = []
+    pool = multiprocessing.dummy.Pool(workers, initializer=_init_ingest_worker)
+    try:
+        for pid, dsid, problem in pool.imap(verify_datastream, recorded_checksums(), 16):
+            checked += 1
+            if problem:
+                print '%s %s - %s' % (pid, dsid, problem)
+                failures.append((pid, dsid, problem))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    print '%s - verified %d datastreams of %d items, %d failed, %d items had no recorded checksums' % (collection_id, checked, counts['items'], len(failures), counts['unrecorded'])
+    return failures
 
-def ingest_collection(collection_id):
-    for item in get_collection_members(collection_id):
-        ingest_item(item)
+def _init_ingest_worker():
+    """
+    Pool initializer, run once in every ingest worker.  The parent closes its database
+    connection before the pool starts, so each worker opens its own on first use; the fedora
+    client is created lazily by _get_worker_fedora_client.
+    """
+    _worker_state.fedora_client = None
 
-def ingest_item(item):
-    fedora_client = connect_to_fedora()
+def _get_worker_fedora_client():
+    client = getattr(_worker_state, 'fedora_client', None)
+    if client is None:
+        client = connect_to_fedora()
+        _worker_state.fedora_client = client
+    return client
+
+def _ingest_item_worker(args):
+    """
+    Ingest one item inside a pool worker and report the outcome as (do_id, ok, message, sent)
+    instead of raising, so one bad item does not take the whole pool down.  @sent is
+    (process id, bytes the process has sent so far), for the run report.
+    """
+    item, files = args
+    fedora_client = _get_worker_fedora_client()
     if not fedora_client:
-        sys.exit(0)        
+        return (item.do_id, False, 'could not connect to fedora', _bytes_sent())
+    try:
+        ok = ingest_item(item, fedora_client, files)
+    except Exception, ex:
+        return (item.do_id, False, '%s: %s' % (ex.__class__.__name__, ex), _bytes_sent())
+    return (item.do_id, bool(ok), '', _bytes_sent())
+
+def _bytes_sent():
+    return (os.getpid(), get_metrics().totalBytes())
+
+def ingest_collection(collection_id, workers=None, use_threads=False, types=None, do_id_range=None, shard=None, report=None):
+    """
+    Ingest every member of a legacy collection.
+
+    @param collection_id: The legacy collection id (a key of COLL_NS_MAP)
+    @param workers: How many items to migrate at once, INGEST_WORKERS if not given.  With 1 the
+        items are ingested serially in this process, otherwise a pool of worker processes (or
+        threads, see use_threads) is used.  Every worker holds its own fedora client and database
+        connection.
+    @param use_threads: Use worker threads instead of processes.
+    @param types, do_id_range, shard: Only ingest part of the collection, see iter_collection_items
+    @param report: A utils.report.RunReport to count the items in
+
+    Returns a list of (do_id, ok, message) tuples in collection order.
+    """
+    if workers is None:
+        workers = INGEST_WORKERS
+    # before the first database query is timed, and the workers are forked
+    get_metrics()
+    if workers <= 1:
+        fedora_client = connect_to_fedora()
+        if not fedora_client:
+            sys.exit(0)
+        results = []
+        try:
+            for item, files in iter_collection_items(collection_id, types, do_id_range, shard):
+                try:
+                    ok = ingest_item(item, fedora_client, files)
+                    result = (item.do_id, bool(ok), '', _bytes_sent())
+                except Exception, ex:
+                    result = (item.do_id, False, '%s: %s' % (ex.__class__.__name__, ex), _bytes_sent())
+                _report_item_result(result, report)
+                results.append(result[:3])
+        finally:
+            # a pool of worker threads for the next collection may need every client
+            disconnect_from_fedora()
+        get_metrics().close()
+        return results
+
+    # drop our database connection before the workers are forked so they don't inherit (and
+    # later close) the parent's socket; the parent reconnects when it loads the members below
+    if not use_threads:
+        from django.db import connection
+        connection.close()
+    else:
+        # every worker thread, and every page pipeline thread of its books, keeps its own pooled
+        # client; make sure there are enough of them
+        getConnectionPool(FEDORA_URL, FEDORA_USER, FEDORA_PASSWORD, fedora_pool_size(workers))
+    pool_class = use_threads and multiprocessing.dummy.Pool or multiprocessing.Pool
+    pool = pool_class(workers, initializer=_init_ingest_worker)
+    results = []
+    try:
+        # imap keeps the results in collection order, the same order a serial run reports them
+        for result in pool.imap(_ingest_item_worker, iter_collection_items(collection_id, types, do_id_range, shard)):
+            _report_item_result(result, report)
+            results.append(result[:3])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    # the workers' records are already on disk, this adds the parent's closing summary
+    get_metrics().close()
+    return results
+
+def _report_item_result(result, report=None):
+    do_id, ok, message, (process, sent) = result
+    if report:
+        report.itemDone(do_id, ok, message, process, sent)
+    if ok:
+        print '%s - ingest ok' % (do_id,)
+    else:
+        print '%s - ingest failed %s' % (do_id, message)
+
+def ingest_item(item, fedora_client=None, files=None):
+    """
+    Ingest a single item.  Returns True when the item was migrated completely, False if it was
+    skipped or part of it is left for the next run.
+    @files is the item's ItemFileManifest, loaded here if not given.  The whole item is timed,
+    and run under cProfile if it is PROFILE_ITEM.
+    """
+    if fedora_client is None:
+        fedora_client = connect_to_fedora()
+        if not fedora_client:
+            sys.exit(0)
     ns = get_collection_namespace(item)
     print '%s - coll namespace: %s' % (item.do_id, ns)
+    pid = get_item_pid(item, ns)
+    if get_journal().isDone(pid, COMPLETE):
+        # only a sync needs the item's files, a skipped item doesn't
+        if INCREMENTAL_SYNC and files is None:
+            files = load_file_manifests([item])[item.pk]
+        if not INCREMENTAL_SYNC or not sync_item(item, files, pid):
+            print '%s - already migrated, skipping' % (item.do_id,)
+            return True
+    metrics = get_metrics()
+    with timed('item', pid=pid, type=item.type.name) as info:
+        if item.do_id == PROFILE_ITEM:
+            profile_path = os.path.join(PROFILE_DIR, '%s.prof' % (item.do_id,))
+            print '%s - profiling to %s' % (item.do_id, profile_path)
+            with profiled(profile_path):
+                ok = migrate_item(item, fedora_client, files, ns, pid)
+        else:
+            ok = migrate_item(item, fedora_client, files, ns, pid)
+        info['ok'] = bool(ok)
+    if ok:
+        metrics.itemDone()
+    return ok
+
+def migrate_item(item, fedora_client, files, ns, pid):
     cm = get_item_content_model(item)
     print '%s - content model: %s' % (item.do_id, cm)
+    if files is None:
+        files = load_file_manifests([item])[item.pk]
     type = item.type.name
-    fedora_object = handle_base_object(fedora_client, item, ns, cm)
+    fedora_object = handle_base_object(fedora_client, item, ns, cm, files)
     if not fedora_object:
-        return
+        return False
+    finished = True
     if type == 'image':
-        handle_image_object(fedora_object, item)
+        finished = handle_image_object(fedora_object, item, files)
     elif type == 'text - uncataloged' or type == 'text - cataloged':
-        handle_text_object(fedora_client, fedora_object, item)
+        finished = handle_text_object(fedora_client, fedora_object, item, files)
     elif type == 'map':
-        handle_map_object(fedora_object, item)
+        finished = handle_map_object(fedora_object, item, files)
     elif type == 'manuscript':
-        handle_manuscript_object(fedora_object, item)
+        finished = handle_manuscript_object(fedora_client, fedora_object, item, files)
     else:
         pass
+    if finished is not False:
+        get_journal().markDone(pid, COMPLETE, collection=item.primary_collection.c_id)
+        record_item_sources(item, files, pid)
+    # False when part of the item is left for the next run
+    return finished is not False
+
+""" incremental sync """
+
+def item_sources(item, files, pid):
+    """
+    Return the current source of every journal step of the item and its pages, as a dict of
+    (pid, step) to (path, member, size, mtime, crc) - see MigrationJournal.recordSources.  Steps
+    in DERIVED_STEPS share the source of the step they derive from and aren't listed.
+    """
+    sources = {}
+    def add_file(step_pid, step, item_file):
+        st = os.stat(item_file.path)
+        sources[(step_pid, step)] = (item_file.path, None, st.st_size, st.st_mtime, None)
+    type = item.type.name
+    for use, step in SOURCE_STEPS:
+        if use in files.files:
+            add_file(pid, step, files.get(use))
+    if type in SINGLE_MASTER_TYPES:
+        add_file(pid, 'TIFF', files.get('MASTER'))
+    elif type == 'manuscript':
+        for page in files.filter('MASTER'):
+            add_file(get_page_pid_for(pid, page), 'TIFF', page)
+    elif type in TEXT_TYPES:
+        ocr_zip = OcrZip(files.get('OCR_ZIP').path)
+        try:
+            for page in files.filter('MASTER'):
+                page_pid = get_page_pid_for(pid, page)
+                add_file(page_pid, 'TIFF', page)
+                ocr_info = ocr_zip.pageInfo(page.name)
+                if ocr_info:
+                    sources[(page_pid, 'OCR')] = (ocr_zip.path, ocr_info.filename, ocr_info.file_size, None, ocr_info.CRC)
+        finally:
+            ocr_zip.close()
+    return sources
+
+def record_item_sources(item, files, pid):
+    """
+    Remember the sources the item was migrated from, for sync_item to compare against.
+    """
+    get_journal().recordSources(item_sources(item, files, pid))
+
+def source_checksum(path, member):
+    if member is None:
+        return fileChecksum(path, 'md5')
+    ocr_zip = OcrZip(path)
+    try:
+        md5 = hashlib.md5()
+        for block in ocr_zip.iterText([ocr_zip.members[member]]):
+            md5.update(block)
+        return md5.hexdigest()
+    finally:
+        ocr_zip.close()
+
+def source_changed(step_pid, step, current, recorded):
+    """
+    Whether the content of a step's source differs from what was pushed.  An unchanged size and
+    mtime (CRC for zip members) means unchanged; otherwise, or when nothing was recorded, the
+    content is compared with the checksum journaled when it was sent, if there is one.
+    """
+    path, member, size, mtime, crc = current
+    if recorded is not None:
+        if recorded == current:
+            return False
+        if recorded[2] != size:
+            return True
+    sent = get_journal().sentChecksum(step_pid, step)
+    if sent is None or sent[0].upper() != 'MD5':
+        return True
+    return source_checksum(path, member) != sent[1].lower()
+
+def sync_item(item, files, pid):
+    """
+    Compare the sources of an already migrated item with the ones recorded when it was pushed,
+    and forget the journal steps (and the complete marks) of whatever changed - including single
+    pages of a book and pages added since - so that ingesting the item again pushes exactly
+    those datastreams.  Returns the number of steps to redo.
+    """
+    journal = get_journal()
+    recorded = journal.sources(pid, children=True)
+    redo = {}
+    # sources that were touched but hold the same content, recorded again so they aren't read next time
+    refreshed = {}
+    for key, current in item_sources(item, files, pid).iteritems():
+        if source_changed(key[0], key[1], current, recorded.get(key)):
+            step_pid, step = key
+            redo.setdefault(step_pid, set()).update((step,) + DERIVED_STEPS.get(step, ()))
+        elif recorded.get(key) != current:
+            refreshed[key] = current
+    if refreshed:
+        journal.recordSources(refreshed)
+    if item.type.name in TEXT_TYPES and [step_pid for step_pid in redo if step_pid != pid]:
+        # BOOKOCR is put together from the pages' ocr
+        redo.setdefault(pid, set()).add('BOOKOCR')
+    if not redo:
+        return 0
+    count = 0
+    for step_pid, steps in redo.iteritems():
+        journal.forgetSteps(step_pid, list(steps) + [COMPLETE])
+        count += len(steps)
+    journal.forgetSteps(pid, [COMPLETE])
+    print '%s - %d changed datastream(s) to push' % (item.do_id, count)
+    return count
+
+def make_run_report(collections):
+    """
+    Return the RunReport for an ingest run of @collections, or None if REPORT_ADDRESSES is empty.
+    """
+    if not REPORT_ADDRESSES:
+        return None
+    transport = None
+    if REPORT_SMTP_HOST:
+        transport = SmtpTransport(REPORT_SMTP_HOST, REPORT_SMTP_PORT, REPORT_SENDER)
+    return RunReport('DRL migration of %s' % (', '.join(collections),), REPORT_ADDRESSES, transport, REPORT_INTERVAL)
+
+def parse_smtp(value):
+    host, colon, port = value.partition(':')
+    try:
+        return host, int(port or 25)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected HOST or HOST:PORT, e.g. localhost:1025")
+
+def parse_shard(value):
+    try:
+        index, shards = [int(n) for n in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected K/N, e.g. 0/4")
+    if shards < 1 or not 0 <= index < shards:
+        raise argparse.ArgumentTypeError("shard %s is outside 0/%d .. %d/%d" % (value, shards, shards - 1, shards))
+    return index, shards
+
+def main(argv=None):
+    global JOURNAL_PATH, INCREMENTAL_SYNC, REPORT_ADDRESSES, REPORT_SMTP_HOST, REPORT_SMTP_PORT
+    parser = argparse.ArgumentParser(description='Migrate legacy DRL collections to fedora.')
+    parser.add_argument('collections', nargs='+', metavar='collection', choices=sorted(COLL_NS_MAP),
+                        help='legacy collection id, one of: %s' % (', '.join(sorted(COLL_NS_MAP)),))
+    parser.add_argument('--shard', type=parse_shard, metavar='K/N',
+                        help='only migrate the items whose do_id hashes to shard K of N (0 <= K < N); '
+                             'running shards 0/N .. N-1/N on N hosts splits a collection without overlap')
+    parser.add_argument('--type', dest='types', action='append', metavar='TYPE',
+                        choices=sorted([t for t in ITEM_TYPE_CM_MAP if t != 'page']),
+                        help='only migrate items of this type, may be given more than once')
+    parser.add_argument('--from-id', metavar='DO_ID', help='only migrate items whose do_id sorts at or after DO_ID')
+    parser.add_argument('--to-id', metavar='DO_ID', help='only migrate items whose do_id sorts at or before DO_ID')
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS, help='items migrated at once (default %(default)s)')
+    parser.add_argument('--threads', action='store_true', help='use worker threads instead of processes')
+    parser.add_argument('--journal', default=JOURNAL_PATH, help='migration journal (default %(default)s)')
+    parser.add_argument('--sync', action='store_true',
+                        help='also revisit migrated items and push the datastreams whose source files changed')
+    parser.add_argument('--report-to', dest='report_addresses', action='append', metavar='ADDRESS',
+                        help='mail run reports (summaries every %d minutes and a digest at the end) to ADDRESS, '
+                             'may be given more than once' % (REPORT_INTERVAL // 60,))
+    parser.add_argument('--smtp', type=parse_smtp, metavar='HOST[:PORT]',
+                        help='send the run reports through this SMTP server instead of mailx')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--dry-run', action='store_true',
+                      help='check the items and estimate the work without touching fedora')
+    mode.add_argument('--verify', action='store_true',
+                      help='compare the checksums recorded during ingest with the ones fedora keeps')
+    args = parser.parse_args(argv)
+
+    JOURNAL_PATH = args.journal
+    INCREMENTAL_SYNC = args.sync
+    if args.report_addresses:
+        REPORT_ADDRESSES = args.report_addresses
+    if args.smtp:
+        REPORT_SMTP_HOST, REPORT_SMTP_PORT = args.smtp
+    do_id_range = None
+    if args.from_id or args.to_id:
+        do_id_range = (args.from_id, args.to_id)
+    report = None
+    if not args.dry_run and not args.verify:
+        report = make_run_report(args.collections)
+    failed = 0
+    try:
+        for collection_id in args.collections:
+            if args.dry_run:
+                failed += plan_collection(collection_id, args.types, do_id_range, args.shard)['failing']
+                continue
+            if args.verify:
+                failed += len(verify_collection(collection_id, args.types, do_id_range, args.shard))
+                continue
+            results = ingest_collection(collection_id, args.workers, args.threads, args.types, do_id_range, args.shard, report)
+            failed += len([result for result in results if not result[1]])
+    finally:
+        # the digest goes out even when the run is interrupted
+        if report:
+            report.finish()
+    if failed:
+        if args.dry_run:
+            print '%d item(s) would fail' % (failed,)
+        elif args.verify:
+            print '%d datastream(s) failed verification' % (failed,)
+        else:
+            print '%d item(s) failed' % (failed,)
+        return 1
+    return 0
 
+if __name__ == '__main__':
+    sys.exit(main())
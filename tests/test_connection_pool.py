@@ -0,0 +1,114 @@
+"""
+Regression tests for the fedora connection pool, run against the local Fedora stand-in
+(benchmarks/fedora_stub.py).  fcrepo, islandoraUtils and lxml must be installed.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import Queue
+import itertools
+import tempfile
+import unittest
+import multiprocessing.dummy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+from fedora_stub import FedoraStub
+from utils import commonFedora
+from utils.commonFedora import connectToFedora, disconnectFromFedora, getConnectionPool
+
+# seconds a pool run may take before the test counts it as hung
+TIMEOUT = 30
+# a user of its own keeps every test on a fresh shared pool (fcrepo can't send long user names)
+_users = itertools.count()
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = FedoraStub().start()
+        self.user = 'user%d' % (_users.next(),)
+        self.pids = itertools.count()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def connect(self, n):
+        client = connectToFedora(self.stub.url, self.user, 'pw', poolSize=2)
+        self.assertNotEqual(client, None)
+        client.createObject(u'test:%d' % (self.pids.next(),), label=u'test')
+        return True
+
+    def runThreadPool(self, threads, tasks):
+        pool = multiprocessing.dummy.Pool(threads)
+        try:
+            return pool.map_async(self.connect, range(tasks)).get(TIMEOUT)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def testSequentialThreadPools(self):
+        # every worker of a pool keeps its client until the pool ends; the next pool's workers
+        # must get them back instead of waiting forever
+        for round in range(3):
+            self.assertEqual(self.runThreadPool(2, 6), [True] * 6)
+        self.assertEqual(getConnectionPool(self.stub.url, self.user, 'pw')._created, 2)
+
+    def testDisconnect(self):
+        connectToFedora(self.stub.url, self.user, 'pw', poolSize=2)
+        disconnectFromFedora(self.stub.url, self.user)
+        self.assertEqual(self.runThreadPool(2, 4), [True] * 4)
+
+    def testDisconnectTwice(self):
+        # once the thread's last client is given back there is nothing left to disconnect
+        connectToFedora(self.stub.url, self.user, 'pw', poolSize=1)
+        disconnectFromFedora(self.stub.url, self.user)
+        disconnectFromFedora(self.stub.url, self.user)
+        self.assertEqual(self.runThreadPool(1, 2), [True] * 2)
+
+    def testBoundClientHeld(self):
+        # a live thread's client is not handed out again
+        connectToFedora(self.stub.url, self.user, 'pw', poolSize=1)
+        pool = getConnectionPool(self.stub.url, self.user, 'pw')
+        self.assertRaises(Queue.Empty, pool.acquire, 0.2)
+        disconnectFromFedora(self.stub.url, self.user)
+        pool.release(pool.acquire(0.2))
+
+class IdleConnectionTest(unittest.TestCase):
+    # the stub closes connections left unused for longer than this
+    KEEP_ALIVE = 0.2
+
+    def setUp(self):
+        self.stub = FedoraStub(keepAliveTimeout=self.KEEP_ALIVE).start()
+        self.pool = getConnectionPool(self.stub.url, 'user%d' % (_users.next(),), 'pw')
+        self.assertEqual(self.pool.request('POST', '/objects/test:0?label=test')[0], 201)
+        # fedora closes the kept-alive connection
+        time.sleep(2 * self.KEEP_ALIVE)
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def upload(self, body):
+        stats = {}
+        status = self.pool.request('POST', '/objects/test:0/datastreams/TEST?controlGroup=M', body, {}, None, stats)[0]
+        self.assertEqual(status, 201)
+        return stats['bytes'], self.pool.request('GET', '/objects/test:0/datastreams/TEST/content')[2]
+
+    def testReplayFile(self):
+        # a file body is sent again, from where it started, on a fresh connection
+        body = tempfile.TemporaryFile()
+        body.write('skipped;content')
+        body.seek(len('skipped;'))
+        self.assertEqual(self.upload(body), (len('content'), 'content'))
+
+    def testIdleConnectionNotTrusted(self):
+        # a body that can only be sent once doesn't go out on a connection unused for long
+        idleReconnect = commonFedora.IDLE_RECONNECT
+        commonFedora.IDLE_RECONNECT = self.KEEP_ALIVE
+        try:
+            self.assertEqual(self.upload(iter(['con', 'tent'])), (len('content'), 'content'))
+        finally:
+            commonFedora.IDLE_RECONNECT = idleReconnect
+
+if __name__ == '__main__':
+    unittest.main()
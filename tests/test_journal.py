@@ -0,0 +1,70 @@
+"""
+Tests for the migration journal.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+import multiprocessing.dummy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.journal import MigrationJournal, COMPLETE
+
+def _openAndMark(args):
+    # pool task: open the journal at @path, as every worker of a run does, and use it
+    path, n = args
+    try:
+        journal = MigrationJournal(path)
+        journal.markDone('test:%d' % (n,), COMPLETE)
+        return journal.isDone('test:%d' % (n,), COMPLETE) or 'step not recorded'
+    except Exception, ex:
+        return '%s: %s' % (ex.__class__.__name__, ex)
+
+class MigrationJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def openConcurrently(self, poolClass, workers=8, rounds=20):
+        for round in range(rounds):
+            path = os.path.join(self.dir, 'journal%d.db' % (round,))
+            pool = poolClass(workers)
+            try:
+                results = pool.map(_openAndMark, [(path, n) for n in range(workers)])
+            finally:
+                pool.close()
+                pool.join()
+            self.assertEqual(results, [True] * workers)
+
+    def testConcurrentCreateProcesses(self):
+        # workers that create a new journal at the same moment must not fail on each other's
+        # schema changes
+        self.openConcurrently(multiprocessing.Pool)
+
+    def testConcurrentCreateThreads(self):
+        self.openConcurrently(multiprocessing.dummy.Pool)
+
+    def testReopen(self):
+        path = os.path.join(self.dir, 'journal.db')
+        MigrationJournal(path).markDoneMany([('test:1', 'object'), ('test:1', 'MODS')])
+        self.assertEqual(MigrationJournal(path).doneSteps('test:1'), set(['object', 'MODS']))
+
+    def testChildren(self):
+        # only the pages of a book are its children, not other items whose pid starts the same
+        journal = MigrationJournal(os.path.join(self.dir, 'journal.db'))
+        pids = ['ns:1', 'ns:1-00000001', 'ns:1-00000002', 'ns:1-a', 'ns:1-2005-00000001', 'ns:10-00000001',
+                'ns:*_%', 'ns:*_%-00000001', 'ns:a_%-00000001', 'ns:*X%-00000001']
+        journal.recordChecksums([(pid, 'TIFF', 'c', 1) for pid in pids])
+        journal.recordSources(dict(((pid, 'TIFF'), ('/p', None, 1, 1.0, None)) for pid in pids))
+        for book, pages in [('ns:1', ['ns:1-00000001', 'ns:1-00000002']), ('ns:*_%', ['ns:*_%-00000001'])]:
+            self.assertEqual([row[0] for row in journal.checksums(book, children=True)], [book] + pages)
+            self.assertEqual(sorted([key[0] for key in journal.sources(book, children=True)]), [book] + pages)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,25 +4,147 @@ Created on Oct. 12 2011
 @author: Jason MacWilliams
 """
 
+import sys
+import Queue
+import smtplib
+import threading
 import subprocess
+from email.mime.text import MIMEText
 
-def sendEmail(addrs, subject, message):
-    print("Sending email (%s) to addresses: %s" % (subject, addrs))
-    subprocess.Popen('echo "%s" | mailx -s "%s" %s' % (message, subject, addrs), shell=True, executable="/bin/bash")
+class MailxTransport:
+    """
+    Sends through the local mailx.  The message goes to mailx on its stdin and the subject and
+    addresses as separate arguments, so nothing passes through a shell and a message of any
+    length or content arrives intact.
+    """
+    def __init__(self, command='mailx'):
+        self.command = command
+
+    def send(self, addrs, subject, message):
+        p = subprocess.Popen([self.command, '-s', subject] + list(addrs), stdin=subprocess.PIPE)
+        p.communicate(message)
+        if p.returncode != 0:
+            raise RuntimeError("%s exited with status %s" % (self.command, p.returncode))
+
+class SmtpTransport:
+    """
+    Sends through an SMTP server, e.g. a local sink (python -m smtpd -n -c DebuggingServer
+    localhost:1025) when testing.
+    """
+    def __init__(self, host='localhost', port=25, sender='root@localhost', timeout=60):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.timeout = timeout
+
+    def send(self, addrs, subject, message):
+        try:
+            message.encode('ascii')
+            charset = 'us-ascii'
+        except UnicodeError:
+            charset = 'utf-8'
+        mail = MIMEText(message, 'plain', charset)
+        mail['Subject'] = subject
+        mail['From'] = self.sender
+        mail['To'] = ', '.join(addrs)
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            smtp.sendmail(self.sender, list(addrs), mail.as_string())
+        finally:
+            smtp.quit()
 
-    # cmd = echo "message" | mailx -s "subject" addresses
+_transport = MailxTransport()
+
+def setTransport(transport):
+    """
+    Make @transport (anything with a send(addrs, subject, message) method) the one sendEmail and
+    EmailMessage.send use by default.
+    """
+    global _transport
+    _transport = transport
+
+def _addressList(addrs):
+    # addresses come as a list or, as sendEmail always took them, one space separated string
+    if isinstance(addrs, basestring):
+        return addrs.split()
+    return list(addrs)
+
+def sendEmail(addrs, subject, message, transport=None):
+    print("Sending email (%s) to addresses: %s" % (subject, addrs))
+    (transport or _transport).send(_addressList(addrs), subject, message)
 
     # XXX: we might want to attach the logfile or something else here.  In that case the order of
     # the print statement and the sendmail should be reversed so the print statement doesn't appear
     # in the log
 
-class EmailMessage:
-    def __init__(self, subject="", addrs=[]):
-        if type(addrs) != list:
+class AsyncSender:
+    """
+    Sends messages on a background thread, so whoever submits them never waits on the mail
+    system.  At most @queueSize messages wait to be sent; submit() drops a message rather than
+    block when they are all taken.  A failed send is printed and otherwise ignored.
+    """
+    def __init__(self, transport=None, queueSize=100):
+        self.transport = transport
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._queue = Queue.Queue(queueSize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='mail-sender')
+                # a run that ends without close() must not hang on its mail
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def submit(self, message):
+        """
+        Queue an EmailMessage for sending.  Returns False if it had to be dropped.
+        """
+        self._start()
+        try:
+            self._queue.put_nowait((message.addrs[:], message.subject, message.message))
+        except Queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            addrs, subject, text = entry
+            try:
+                sendEmail(addrs, subject, text, self.transport)
+                self.sent += 1
+            except Exception, ex:
+                self.failed += 1
+                print >> sys.stderr, "Sending email (%s) failed: %s" % (subject, ex)
+
+    def close(self, timeout=None):
+        """
+        Send whatever is still queued, waiting up to @timeout seconds for it, and stop the thread.
+        """
+        if self._thread is None:
             return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+class EmailMessage(object):
+    def __init__(self, subject="", addrs=[]):
         self.subject = subject
-        self.addrs = addrs
-        self.message = ""
+        self.addrs = _addressList(addrs)
+        # the text is kept as a list of pieces and joined once when it is read, appending a line
+        # doesn't copy everything before it
+        self._parts = []
 
     def addAddress(self, addr):
         if type(addr) == str and not addr in self.addrs:
@@ -36,15 +158,22 @@ class EmailMessage:
         self.subject = subject
 
     def clearMessage(self):
-        self.message = ""
+        self._parts = []
 
     def addLine(self, line):
-        self.message = self.message + "\n" + line
+        self._parts.append("\n")
+        self._parts.append(line)
 
     def addString(self, string):
-        self.message = self.message + string
+        self._parts.append(string)
+
+    @property
+    def message(self):
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts and self._parts[0] or ""
 
-    def send(self):
+    def send(self, transport=None):
         if self.subject and self.addrs:
-            sendEmail(" ".join(self.addrs), self.subject, self.message)
+            sendEmail(self.addrs, self.subject, self.message, transport)
         print("Email report sent")
@@ -1,37 +1,651 @@
 # -*- coding: utf8 -*-
 from types import DictType
+from contextlib import contextmanager
 import os
+import threading
+import Queue
+import base64
+import httplib
+import socket
+import urllib
+import urlparse
+import time
+import random
+import hashlib
+from lxml import etree
 from islandoraUtils import fileConverter as converter
 from islandoraUtils import fileManipulator
 from islandoraUtils import misc
 from islandoraUtils import fedoraLib
 from islandoraUtils.metadata import fedora_relationships # for RELS-EXT stuff
+from utils.foxml import buildFoxml, buildRelsExt
+from utils.metrics import getMetrics, timed
 # fcrepo imports
 from fcrepo.connection import Connection, FedoraConnectionException
 from fcrepo.client import FedoraClient
 
-def connectToFedora(url, user, pw):
+# default number of fedora connections a process keeps open per repository
+DEFAULT_POOL_SIZE = 4
+# size of the blocks streamed bodies are read and sent in
+STREAM_BLOCK_SIZE = 1024 * 1024
+# checksum computed while datastream content is sent, and asked of fedora for the same content
+CHECKSUM_TYPE = 'MD5'
+# seconds between the looks a blocked acquire() takes for clients bound to threads that have ended
+RECLAIM_INTERVAL = 1.0
+# seconds a kept-alive connection may sit unused before a body that can't be sent again goes out
+# on a fresh connection instead; the server may have closed it in the meantime
+IDLE_RECONNECT = 5.0
+
+class AimdThrottle:
+    """
+    Client side throttle for the requests one process sends to fedora, adapting like TCP
+    congestion control (additive increase, multiplicative decrease).  Two limits are kept: the
+    number of requests in flight, and the upload bandwidth (unlimited until fedora first shows
+    signs of overload).  While requests succeed within @targetLatency seconds both limits grow by
+    a little; a failed request (5xx, a dropped connection, fedora's object lock errors) or a
+    smoothed latency above @targetLatency cuts them by @decrease, at most once per
+    @targetLatency seconds so that one burst of errors counts as one overload.  Every process
+    throttles itself, and like TCP the processes sharing a fedora converge on fair shares.
+    """
+    def __init__(self, initialLimit=4, minLimit=1, maxLimit=32, targetLatency=5.0, decrease=0.5,
+                 minBandwidth=256 * 1024, bandwidthStep=1024 * 1024):
+        self.limit = float(initialLimit)
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.targetLatency = targetLatency
+        self.decrease = decrease
+        # bytes per second, None for no limit
+        self.bandwidth = None
+        self.minBandwidth = minBandwidth
+        self.bandwidthStep = bandwidthStep
+        self.inFlight = 0
+        self.latency = None
+        self.counts = {'requests': 0, 'overloads': 0, 'decreases': 0}
+        self._cond = threading.Condition(threading.Lock())
+        self._lastDecrease = 0
+        # bytes sent since _rateStart, for the observed upload rate
+        self._rateStart = time.time()
+        self._rateBytes = 0
+        self._rate = None
+        # token bucket of the bandwidth limit
+        self._tokens = 0
+        self._tokensTime = time.time()
+
+    def acquire(self):
+        """
+        Wait for a free in-flight slot.
+        """
+        self._cond.acquire()
+        try:
+            while self.inFlight >= int(self.limit):
+                self._cond.wait()
+            self.inFlight += 1
+        finally:
+            self._cond.release()
+
+    def release(self, latency, overloaded=False):
+        """
+        Give back the slot of a finished request that took @latency seconds to be answered, and
+        adapt the limits; @overloaded marks a request that failed in a way that points at fedora
+        being overloaded.
+        """
+        self._cond.acquire()
+        try:
+            self.inFlight -= 1
+            self.counts['requests'] += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            if overloaded:
+                self.counts['overloads'] += 1
+            if overloaded or self.latency > self.targetLatency:
+                self._decrease()
+            else:
+                # about one more slot per round trip of all the slots
+                self.limit = min(self.maxLimit, self.limit + 1.0 / self.limit)
+                if self.bandwidth is not None:
+                    self.bandwidth += self.bandwidthStep / self.limit
+                    if self._rate and self.bandwidth > 2 * self._rate:
+                        # the limit no longer holds anything back
+                        self.bandwidth = None
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _decrease(self):
+        now = time.time()
+        if now - self._lastDecrease < self.targetLatency:
+            return
+        self._lastDecrease = now
+        self.counts['decreases'] += 1
+        self.limit = max(self.minLimit, self.limit * self.decrease)
+        rate = self.bandwidth or self._rate
+        if rate:
+            self.bandwidth = max(self.minBandwidth, rate * self.decrease)
+
+    def consume(self, size):
+        """
+        Account for @size bytes about to be sent, sleeping as long as the bandwidth limit needs.
+        """
+        self._cond.acquire()
+        try:
+            now = time.time()
+            self._rateBytes += size
+            if now - self._rateStart >= 5.0:
+                self._rate = self._rateBytes / (now - self._rateStart)
+                self._rateStart, self._rateBytes = now, 0
+            if self.bandwidth is None:
+                return
+            # at most one second worth of sending saved up
+            self._tokens = min(self.bandwidth, self._tokens + (now - self._tokensTime) * self.bandwidth)
+            self._tokensTime = now
+            self._tokens -= size
+            wait = self._tokens < 0 and -self._tokens / self.bandwidth or 0
+        finally:
+            self._cond.release()
+        if wait:
+            time.sleep(wait)
+
+    def limits(self):
+        """
+        Return the current limits and counters: in-flight limit and count, bandwidth limit (bytes
+        per second, None when unlimited), observed upload rate and smoothed latency.
+        """
+        self._cond.acquire()
+        try:
+            limits = {'limit': int(self.limit), 'in_flight': self.inFlight, 'bandwidth': self.bandwidth and int(self.bandwidth),
+                      'rate': self._rate and int(self._rate), 'latency': self.latency and round(self.latency, 3)}
+            limits.update(self.counts)
+            return limits
+        finally:
+            self._cond.release()
+
+def _isOverload(ex):
+    # fedora answers 5xx when it is struggling, object lock contention included
+    return not isinstance(ex, FedoraConnectionException) or not ex.httpcode or ex.httpcode >= 500
+
+class FedoraConnectionPool:
+    """
+    A pool of persistent (keep-alive) fedora connections to a single repository.  Each pooled
+    entry is a FedoraClient wrapped around its own fcrepo Connection, created on first demand and
+    kept open, so the connection setup and authentication are paid once per pooled client rather
+    than once per object.  At most @size clients exist at once; acquire() blocks when they are all
+    checked out.  A pool notices when it has been inherited by a forked worker and starts over
+    with fresh connections there, so sockets are never shared between processes.
+
+    A client can also be bound to the thread that acquired it (see connectToFedora): it then
+    stays checked out while the thread lives and is taken back by acquire() once the thread has
+    ended, so the worker threads of one thread pool leave their clients to the next.
+
+    Every request made through the pool, by its clients or by request(), passes through the
+    pool's throttle (an AimdThrottle made by @throttleFactory, None for no throttling).
+    """
+    def __init__(self, url, user, pw, size=DEFAULT_POOL_SIZE, throttleFactory=AimdThrottle):
+        self.url = url
+        self.user = user
+        self.pw = pw
+        self.size = max(1, size)
+        self._throttleFactory = throttleFactory
+        scheme, netloc, path = urlparse.urlsplit(url)[:3]
+        self._httpClass = scheme == 'https' and httplib.HTTPSConnection or httplib.HTTPConnection
+        self._netloc = netloc
+        self._basePath = path.rstrip('/')
+        self._auth = 'Basic ' + base64.b64encode('%s:%s' % (user, pw))
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = Queue.LifoQueue()
+        self._created = 0
+        # id(client) -> (thread, client) for the clients bound to a thread
+        self._bound = {}
+        # raw http connections used by request(), one per thread
+        self._http = threading.local()
+        self.throttle = self._throttleFactory and self._throttleFactory() or None
+
+    def _checkFork(self):
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._reset()
+
+    def _newClient(self):
+        connection = Connection(self.url, username=self.user, password=self.pw, persistent=True)
+        if self.throttle:
+            connection.open = self._throttled(connection.open)
+        client = FedoraClient(connection)
+        # lets streamDatastream find its way back to the pool from a fedora object
+        client.connectionPool = self
+        return client
+
+    def _throttled(self, open):
+        # wraps fcrepo's Connection.open, which every FedoraClient call goes through
+        def throttledOpen(*args, **kwargs):
+            throttle = self.throttle
+            throttle.acquire()
+            start = time.time()
+            overloaded = False
+            try:
+                return open(*args, **kwargs)
+            except Exception, ex:
+                overloaded = _isOverload(ex)
+                raise
+            finally:
+                throttle.release(time.time() - start, overloaded)
+        return throttledOpen
+
+    def limits(self):
+        """
+        The throttle's current limits, see AimdThrottle.limits; None without a throttle.
+        """
+        self._checkFork()
+        return self.throttle and self.throttle.limits()
+
+    def acquire(self, timeout=None):
+        """
+        Check a client out of the pool, connecting a new one if the pool isn't full yet.  Raises
+        Queue.Empty if @timeout seconds pass without a client becoming free.
+        """
+        self._checkFork()
+        self._reclaim()
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        self._lock.acquire()
+        create = self._created < self.size
+        if create:
+            self._created += 1
+        self._lock.release()
+        if not create:
+            return self._wait(timeout)
+        try:
+            return self._newClient()
+        except:
+            self.discard(None)
+            raise
+
+    def _wait(self, timeout):
+        # a client bound to a thread that ends while we wait only comes back through _reclaim
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            wait = RECLAIM_INTERVAL
+            if timeout is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise Queue.Empty
+            try:
+                return self._idle.get(timeout=wait)
+            except Queue.Empty:
+                self._reclaim()
+
+    def bind(self, client, thread=None):
+        """
+        Bind a checked out client to @thread (the calling thread if None): the pool takes it
+        back by itself once the thread has ended, unless it is released before.
+        """
+        self._lock.acquire()
+        self._bound[id(client)] = (thread or threading.currentThread(), client)
+        self._lock.release()
+
+    def _reclaim(self):
+        self._lock.acquire()
+        try:
+            ended = [key for key, (thread, client) in self._bound.iteritems() if not thread.isAlive()]
+            clients = [self._bound.pop(key)[1] for key in ended]
+        finally:
+            self._lock.release()
+        for client in clients:
+            self._idle.put(client)
+
+    def release(self, client):
+        """
+        Return a client to the pool.
+        """
+        self._unbind(client)
+        self._idle.put(client)
+
+    def discard(self, client):
+        """
+        Drop a broken client instead of returning it, making room for a new connection.
+        """
+        self._unbind(client)
+        self._lock.acquire()
+        self._created -= 1
+        self._lock.release()
+
+    def _unbind(self, client):
+        self._lock.acquire()
+        self._bound.pop(id(client), None)
+        self._lock.release()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        with pool.connection() as fedora: ... - check out a client for the duration of the block.
+        """
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except FedoraConnectionException:
+            # a connection level failure may have left the http connection unusable
+            self.discard(client)
+            raise
+        except:
+            self.release(client)
+            raise
+        self.release(client)
+
+    def _httpConnection(self):
+        self._checkFork()
+        conn = getattr(self._http, 'conn', None)
+        if conn is None:
+            conn = self._httpClass(self._netloc)
+            conn.connect()
+            # headers and body go out as separate writes; with Nagle on, the body waits for the
+            # server's delayed ACK of the headers, some 40ms on every request
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._http.conn = conn
+            self._http.usedAt = time.time()
+        return conn
+
+    def request(self, method, path, body=None, headers={}, length=None, stats=None, digest=None):
+        """
+        Send a REST API request over this thread's persistent http connection and return
+        (status, reason, response body).
+        @param path The path below the fedora url, e.g. '/objects/demo:1/datastreams/TIFF?...'
+        @param body None, a string, a file-like object or an iterable of strings.  File-like objects
+               and iterables are sent block by block as they are read, never held in memory whole.
+               Strings and seekable files are sent again if the connection turns out closed.
+        @param length The number of bytes in @body, if it isn't a string.  Without it a file's size
+               is taken from the file itself, and anything else is sent chunked.
+        @param stats [optional] A dict whose 'bytes' is set to the number of body bytes sent
+        @param digest [optional] A hashlib algorithm name; the hex digest of the body, computed as
+               it is sent, is put in @stats as 'checksum'
+        """
+        if body is None:
+            body = ''
+        if isinstance(body, basestring):
+            length = len(body)
+        elif length is None and hasattr(body, 'fileno'):
+            try:
+                length = os.fstat(body.fileno()).st_size - body.tell()
+            except (OSError, IOError, AttributeError):
+                pass
+        self._checkFork()
+        throttle = self.throttle
+        if throttle is None:
+            return self._request(method, path, body, headers, length, stats, digest)
+        throttle.acquire()
+        start = time.time()
+        self._http.latency = None
+        overloaded = False
+        try:
+            status, reason, data = self._request(method, path, body, headers, length, stats, digest)
+            overloaded = status >= 500
+            return status, reason, data
+        except Exception, ex:
+            overloaded = _isOverload(ex)
+            raise
+        finally:
+            # the wait for the answer, not the upload, is what tells how busy fedora is
+            latency = self._http.latency
+            if latency is None:
+                latency = time.time() - start
+            throttle.release(latency, overloaded)
+
+    def _request(self, method, path, body, headers, length, stats, digest):
+        # a kept-alive connection the server has since closed only shows up once we use it;
+        # requests we can send again get one more try on a fresh connection
+        start = _bodyStart(body)
+        replayable = start is not None
+        for attempt in (1, 2):
+            conn = self._httpConnection()
+            if not replayable and time.time() - self._http.usedAt > IDLE_RECONNECT:
+                # too long unused to trust it with a body that can only be sent once
+                conn.close()
+                self._http.conn = None
+                conn = self._httpConnection()
+            if attempt == 2 and not isinstance(body, basestring):
+                body.seek(start)
+            try:
+                return self._send(conn, method, self._basePath + path, body, headers, length, stats, digest)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                self._http.conn = None
+                if not replayable or attempt == 2:
+                    raise
+            except:
+                # e.g. the body failed while being read; the request is half sent
+                conn.close()
+                self._http.conn = None
+                raise
+
+    def _send(self, conn, method, url, body, headers, length, stats, digest):
+        conn.putrequest(method, url, skip_accept_encoding=True)
+        conn.putheader('Authorization', self._auth)
+        for k, v in headers.iteritems():
+            conn.putheader(k, v)
+        chunked = length is None
+        if chunked:
+            conn.putheader('Transfer-Encoding', 'chunked')
+        else:
+            conn.putheader('Content-Length', str(length))
+        conn.endheaders()
+        sent = 0
+        # a fresh hash for every attempt, a retried request is hashed again from the start
+        hash = digest and hashlib.new(digest)
+        for block in _iterBlocks(body):
+            if not block:
+                continue
+            sent += len(block)
+            if hash:
+                hash.update(block)
+            if self.throttle:
+                self.throttle.consume(len(block))
+            if chunked:
+                conn.send('%x\r\n%s\r\n' % (len(block), block))
+            else:
+                conn.send(block)
+        if chunked:
+            conn.send('0\r\n\r\n')
+        if stats is not None:
+            stats['bytes'] = sent
+            if hash:
+                stats['checksum'] = hash.hexdigest()
+        sentAt = time.time()
+        response = conn.getresponse()
+        self._http.latency = time.time() - sentAt
+        data = response.read()
+        self._http.usedAt = time.time()
+        if response.getheader('connection', '').lower() == 'close':
+            conn.close()
+            self._http.conn = None
+        return response.status, response.reason, data
+
+def _bodyStart(body):
+    """
+    Return where sending @body starts - 0 for a string, the current offset of a seekable file -
+    or None if it can only be sent once.
+    """
+    if isinstance(body, basestring):
+        return 0
+    if not hasattr(body, 'seek') or not hasattr(body, 'tell'):
+        return None
+    try:
+        return body.tell()
+    except (IOError, OSError, AttributeError):
+        return None
+
+def _iterBlocks(body):
+    if isinstance(body, basestring):
+        yield body
+    elif hasattr(body, 'read'):
+        while True:
+            block = body.read(STREAM_BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+    else:
+        for block in body:
+            yield block
+
+_pools = {}
+_poolsLock = threading.Lock()
+# clients bound to the current worker thread by connectToFedora, keyed like _pools
+_workerClients = threading.local()
+
+def getConnectionPool(url, user, pw, size=None):
+    """
+    Return the shared FedoraConnectionPool for this repository and user, creating it on first use.
+    @size sets the pool size on creation (DEFAULT_POOL_SIZE if not given); a larger @size grows
+    an existing pool.
+    """
+    key = (url, user)
+    _poolsLock.acquire()
+    try:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = FedoraConnectionPool(url, user, pw, size or DEFAULT_POOL_SIZE)
+            _pools[key] = pool
+            getMetrics().addCounters('throttle', pool.limits)
+        elif size and size > pool.size:
+            pool.size = size
+    finally:
+        _poolsLock.release()
+    return pool
+
+def connectToFedora(url, user, pw, poolSize=None):
     """
     Attempt to create a connection to fedora using the supplied username and password.  If the
     connection succeeds, return the connected fedora client, otherwise return None.  The calling
     function should terminate if None is received.
+
+    The client comes from the shared connection pool and stays bound to the calling thread, so
+    repeated calls from the same worker reuse one persistent connection.  It goes back to the
+    pool when the thread ends, or when the thread calls disconnectFromFedora.
     """
-    try:
-        connection = Connection(url, username=user, password=pw)
-    except Exception, ex:
-        print("Error while connecting to fedoraUrl: %s", ex.message)
-        return None
+    key = (url, user, os.getpid())
+    clients = getattr(_workerClients, 'clients', None)
+    if clients is None:
+        clients = _workerClients.clients = {}
+    if key in clients:
+        return clients[key]
 
     try:
-        return FedoraClient(connection)
+        pool = getConnectionPool(url, user, pw, poolSize)
+        client = pool.acquire()
     except Exception, ex:
-        print("Exception while opening fedora client")
+        print("Error while connecting to fedoraUrl: %s" % ex)
         print("Check if fedora is running and your login information is correct")
-    return None
+        return None
+    pool.bind(client)
+    clients[key] = client
+    return client
+
+def disconnectFromFedora(url, user):
+    """
+    Return the client connectToFedora bound to the calling thread, if any, to the pool.
+    """
+    clients = getattr(_workerClients, 'clients', None)
+    client = clients.pop((url, user, os.getpid()), None) if clients else None
+    if client is not None:
+        client.connectionPool.release(client)
 
 """ ====== MANAGING FEDORA OBJECTS ====== """
 
-def createRelsExt(childObject, parentPid, contentModel, extraNamespaces={}, extraRelationships={}):
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: before retry n the caller sleeps a random time between
+    0 and min(maxDelay, baseDelay * 2**(n-1)) seconds, and gives up after maxAttempts attempts.
+    """
+    def __init__(self, maxAttempts=8, baseDelay=0.1, maxDelay=10.0):
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * (2 ** (attempt - 1))))
+
+# used by createRelsExt when fedora reports the object is locked by another thread
+RELS_EXT_RETRY = RetryPolicy()
+
+_relsExtStats = {'updates': 0, 'contended': 0, 'retries': 0, 'failures': 0}
+_relsExtStatsLock = threading.Lock()
+
+def _countRelsExt(name):
+    _relsExtStatsLock.acquire()
+    _relsExtStats[name] += 1
+    _relsExtStatsLock.release()
+
+def relsExtStats():
+    """
+    Return the RELS-EXT counters of this process: successful updates, updates that hit a lock
+    held by another thread at least once, retries, and updates given up on.
+    """
+    _relsExtStatsLock.acquire()
+    try:
+        return dict(_relsExtStats)
+    finally:
+        _relsExtStatsLock.release()
+
+getMetrics().addCounters('rels_ext', relsExtStats)
+
+def streamDatastream(obj, dsid, body, label=u'', mimeType=u'application/octet-stream', controlGroup=u'M', length=None):
+    """
+    Add or replace a datastream of obj, sending its content straight from @body instead of
+    from a file on disk.
+    @param obj A FedoraObject whose client came from a FedoraConnectionPool
+    @param dsid The datastream to create or replace
+    @param body A string, a file-like object (e.g. an open file or ZipFile.open() member) or
+           a generator of strings.  It is read block by block while it is sent.
+    @param length The total size of @body if known; without it the upload is sent chunked.
+    The caller remains responsible for closing @body.
+
+    Returns (checksum, size) of the content sent, the checksum (CHECKSUM_TYPE, hex) computed
+    on the way out; fedora is asked to keep a checksum of the same type for the datastream.
+    """
+    pool = getattr(obj.client, 'connectionPool', None)
+    if pool is None:
+        raise ValueError("object %s was not loaded through a FedoraConnectionPool" % obj.pid)
+    if isinstance(label, unicode):
+        label = label.encode('utf-8')
+    params = {'dsLabel': label, 'mimeType': mimeType, 'checksumType': CHECKSUM_TYPE}
+    if dsid in obj:
+        method = 'PUT'
+    else:
+        method = 'POST'
+        params['controlGroup'] = controlGroup
+    path = '/objects/%s/datastreams/%s?%s' % (urllib.quote(obj.pid, safe=':'), urllib.quote(dsid), urllib.urlencode(params))
+    with timed('fedora.datastream', pid=obj.pid, dsid=dsid, method=method) as info:
+        status, reason, data = pool.request(method, path, body, {'Content-Type': mimeType}, length, info, CHECKSUM_TYPE.lower())
+    if status >= 300:
+        raise FedoraConnectionException(status, reason, data)
+    return info['checksum'], info['bytes']
+
+def getDatastreamChecksum(fedora, pid, dsid):
+    """
+    Return (checksumType, checksum) fedora holds for datastream @dsid of object @pid, from the
+    datastream profile.  The checksum is 'none' when fedora has no checksum for it.
+    @fedora must be a client from a FedoraConnectionPool.
+    """
+    pool = getattr(fedora, 'connectionPool', None)
+    if pool is None:
+        raise ValueError("fedora client was not created by a FedoraConnectionPool")
+    path = '/objects/%s/datastreams/%s?format=xml' % (urllib.quote(pid, safe=':'), urllib.quote(dsid))
+    status, reason, data = pool.request('GET', path)
+    if status >= 300:
+        raise FedoraConnectionException(status, reason, data)
+    values = {'dsChecksumType': 'none', 'dsChecksum': 'none'}
+    for element in etree.fromstring(data).iter():
+        # the profile's namespace differs between fedora versions, match on the local name
+        name = element.tag.split('}')[-1]
+        if name in values and element.text and element.text.strip():
+            values[name] = element.text.strip()
+    return values['dsChecksumType'], values['dsChecksum']
+
+def createRelsExt(childObject, parentPid, contentModel, extraNamespaces={}, extraRelationships={}, retryPolicy=None):
     """
     Create the RELS-EXT relationships between childObject and object:parentPid
     We set the default namespace for our interconnections, then apply the content model, and make
@@ -43,6 +657,8 @@ def createRelsExt(childObject, parentPid, contentModel, extraNamespaces={}, extr
     @param extraNamespaces Any @extraNamespaces to put in the RELS-EXT data.
     @param extraRelationsips Any additional relationship values to assign to childObject.  By default
            the object gets: hasModel:contentModel and isMemberOfCollection:parentPid
+    @param retryPolicy [optional] How to retry while fedora reports the object locked by another
+           thread, RELS_EXT_RETRY by default.  Once it gives up the FedoraConnectionException is raised.
     """
 
     nsmap = [ fedora_relationships.rels_namespace('fedora', 'info:fedora/fedora-system:def/relations-external#'),
@@ -61,19 +677,50 @@ def createRelsExt(childObject, parentPid, contentModel, extraNamespaces={}, extr
         for k, v in extraRelationships.iteritems():
             rels_ext.addRelationship(k, [v, "pid"]) # use pid instead of literal so it is stored in rdf:resource instead of the text node
 
-    loop = True
-    while loop:
-        loop = False
+    retryPolicy = retryPolicy or RELS_EXT_RETRY
+    attempt = 0
+    while True:
+        attempt += 1
         try:
-            rels_ext.update()
+            with timed('fedora.rels-ext', pid=childObject.pid, attempt=attempt):
+                rels_ext.update()
+            _countRelsExt('updates')
         except FedoraConnectionException, fedoraEXL:
             if str(fedoraEXL.body).find("is currently being modified by another thread") != -1:
-                loop = True
+                if attempt == 1:
+                    _countRelsExt('contended')
+                if attempt >= retryPolicy.maxAttempts:
+                    _countRelsExt('failures')
+                    print("Giving up updating obj(%s) RELS-EXT after %d attempts" % (childObject.pid, attempt))
+                    raise
+                _countRelsExt('retries')
                 print("Trouble (thread lock) updating obj(%s) RELS-EXT - retrying." % childObject.pid)
+                time.sleep(retryPolicy.delay(attempt))
+                continue
             else:
                 print("Error updating obj(%s) RELS-EXT" % childObject.pid)
+        break
     return rels_ext
 
+def ingestFoxml(fedora, pid, foxml, length=None, returnObject=True):
+    """
+    Create object @pid from the FOXML document @foxml (a string, file-like object or generator, as
+    for FedoraConnectionPool.request, with @length its size if known) in one ingest call, and
+    return the new FedoraObject - or None when @returnObject is False, which saves fetching it.
+    @fedora must be a client from a FedoraConnectionPool.
+    """
+    pool = getattr(fedora, 'connectionPool', None)
+    if pool is None:
+        raise ValueError("fedora client was not created by a FedoraConnectionPool")
+    path = '/objects/%s?%s' % (urllib.quote(pid, safe=':'), urllib.urlencode({'format': 'info:fedora/fedora-system:FOXML-1.1'}))
+    with timed('fedora.ingest', pid=pid) as info:
+        status, reason, data = pool.request('POST', path, foxml, {'Content-Type': 'text/xml; charset=utf-8'}, length, info)
+    if status >= 300:
+        raise FedoraConnectionException(status, reason, data)
+    if not returnObject:
+        return None
+    return fedora.getObject(pid)
+
 def addCollectionToFedora(fedora, myLabel, myPid, parentPid="islandora:root", contentModel="islandora:collectionCModel", tnUrl=None, extraNamespaces={}, extraRelationships={}):
     """
     Add a collection (not an object) to fedora
@@ -113,7 +760,7 @@ def addCollectionToFedora(fedora, myLabel, myPid, parentPid="islandora:root", co
 
     return collection_object
 
-def addObjectToFedora(fedora, myLabel, myPid, parentPid, contentModel, tnUrl=None, extraNamespaces={}, extraRelationships={}):
+def addObjectToFedora(fedora, myLabel, myPid, parentPid, contentModel, tnUrl=None, extraNamespaces={}, extraRelationships={}, relsExtInCreate=False):
     """
     Add an object (not a collection) to fedora
     @param fedora The fedora instance to add the object to
@@ -122,6 +769,8 @@ def addObjectToFedora(fedora, myLabel, myPid, parentPid, contentModel, tnUrl=Non
     @parentPid The parent object to nest this one under
     @contentModel The content model to attach to this object
     @tnUrl [optional] The url of an image to use as the thumbnail
+    @relsExtInCreate [optional] Send the RELS-EXT inside the FOXML the object is created from,
+                     instead of updating it after createObject.  Needs a pooled fedora client.
     """
     # check for invalid parentPid, invalid contentModel
 
@@ -129,7 +778,8 @@ def addObjectToFedora(fedora, myLabel, myPid, parentPid, contentModel, tnUrl=Non
     # validate the pid
     try:
         # try to create the fedora object
-        obj = fedora.getObject(myPid)
+        with timed('fedora.lookup', pid=myPid):
+            obj = fedora.getObject(myPid)
         print("Attempted to create already existing object %s" % myPid)
         return obj
     except FedoraConnectionException, fcx:
@@ -137,7 +787,12 @@ def addObjectToFedora(fedora, myLabel, myPid, parentPid, contentModel, tnUrl=Non
             # this will throw a bunch of exceptions - all of them to the tune of "cannot connect to fedora"
             raise fcx
 
-    obj = fedora.createObject(myPid, label=myLabel)
+    if relsExtInCreate:
+        relsExt = buildRelsExt(myPid, contentModel, parentPid, extraNamespaces, extraRelationships)
+        obj = ingestFoxml(fedora, myPid, buildFoxml(myPid, myLabel, relsExt))
+    else:
+        with timed('fedora.create', pid=myPid):
+            obj = fedora.createObject(myPid, label=myLabel)
     print("Object created")
 
     # thumbnail, if one is supplied
@@ -148,6 +803,7 @@ def addObjectToFedora(fedora, myLabel, myPid, parentPid, contentModel, tnUrl=Non
         fedoraLib.update_datastream(obj, u'TN', tnUrl, label=u"%s_TN%s" % (myLabel, tnExt), mimeType=misc.getMimeType(tnExt))
 
     # rels-ext relations
-    obj_relsext = createRelsExt(obj, parentPid, contentModel, extraNamespaces=extraNamespaces, extraRelationships=extraRelationships)
+    if not relsExtInCreate:
+        obj_relsext = createRelsExt(obj, parentPid, contentModel, extraNamespaces=extraNamespaces, extraRelationships=extraRelationships)
 
     return obj
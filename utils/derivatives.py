@@ -0,0 +1,378 @@
+"""
+Derivative generation for master TIFFs.
+
+Encoding backends are small classes registered by name, so the encoder can be picked in the
+migration settings.  A DerivativeEngine runs the encoder in a pool of worker processes and keeps
+the results in an on-disk cache keyed by a checksum of the source TIFF, so reruns and retries
+reuse what was already encoded instead of paying for the encode again.  MixExtractor does the
+same for MIX technical metadata (jhove piped through xsltproc).
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import multiprocessing.dummy
+
+class Jp2Encoder:
+    """
+    Base class of the JP2 encoding backends.
+    """
+    def encode(self, tiffPath, workDir):
+        """
+        Encode @tiffPath, writing whatever scratch files are needed into @workDir (which the caller
+        removes afterwards), and return the path of the jp2.
+        """
+        raise NotImplementedError()
+
+class DlxsJp2Encoder(Jp2Encoder):
+    """
+    The DLXS encodeJp2 script.  It writes the jp2 next to its input and prints its path.
+    """
+    encoder = '/usr/local/dlxs/prep/i/image/encodeJp2'
+
+    def encode(self, tiffPath, workDir):
+        # the script writes next to its input; a link to the master saves copying it
+        source = os.path.join(workDir, os.path.basename(tiffPath))
+        os.symlink(tiffPath, source)
+        p = subprocess.Popen([self.encoder, source], stdout=subprocess.PIPE)
+        jp2Path = p.communicate()[0].strip()
+        if p.returncode != 0 or not jp2Path or not os.path.exists(jp2Path):
+            raise RuntimeError("encodeJp2 failed for %s (exit status %s)" % (tiffPath, p.returncode))
+        return jp2Path
+
+class IslandoraJp2Encoder(Jp2Encoder):
+    """
+    The islandoraUtils fileConverter (kakadu based) encoder.
+    """
+    def encode(self, tiffPath, workDir):
+        from islandoraUtils import fileConverter as converter
+        jp2Path = os.path.join(workDir, "%s.jp2" % os.path.splitext(os.path.basename(tiffPath))[0])
+        if not converter.tif_to_jp2(tiffPath, jp2Path, 'default', 'default'):
+            raise RuntimeError("tif_to_jp2 failed for %s" % tiffPath)
+        return jp2Path
+
+_encoders = {
+    'dlxs': DlxsJp2Encoder,
+    'islandora': IslandoraJp2Encoder,
+}
+
+def registerEncoder(name, encoderClass):
+    """
+    Make a Jp2Encoder subclass available to DerivativeEngine under @name.  Register encoders at
+    import time, so worker processes forked later know them too.
+    """
+    _encoders[name] = encoderClass
+
+def getEncoder(name):
+    try:
+        return _encoders[name]()
+    except KeyError:
+        raise ValueError("unknown jp2 encoder '%s', choose from: %s" % (name, ", ".join(sorted(_encoders))))
+
+# checksums of files already hashed by this process, keyed by (path, size, mtime)
+_checksums = {}
+_checksumsLock = threading.Lock()
+
+def fileChecksum(path, algorithm='sha1', blockSize=1024 * 1024):
+    """
+    Return the hex digest of the file at @path.  The result is remembered for as long as the
+    file's size and modification time don't change, so a master is read once per process.
+    """
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime, algorithm)
+    _checksumsLock.acquire()
+    digest = _checksums.get(key)
+    _checksumsLock.release()
+    if digest:
+        return digest
+    h = hashlib.new(algorithm)
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                break
+            h.update(block)
+    finally:
+        f.close()
+    digest = h.hexdigest()
+    _checksumsLock.acquire()
+    _checksums[key] = digest
+    _checksumsLock.release()
+    return digest
+
+class DerivativeCache:
+    """
+    Content addressed store of derivatives: <cacheDir>/<key[:2]>/<key><ext>.  Entries are moved
+    into place with a rename, so concurrent workers never see a half written file.
+
+    With @maxBytes the cache is kept to about that size by removing the least recently used
+    entries, a hit counting as a use.  Every process keeps a running total of its own and only
+    measures the directory again once it is over @maxBytes or has added a tenth of it, so the
+    processes sharing a cache each overshoot it by at most that tenth.
+    """
+    def __init__(self, cacheDir, maxBytes=None):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        # bytes in the cache when it was last measured, and added by this process since
+        self._size = None
+        self._added = 0
+
+    def path(self, key, ext):
+        return os.path.join(self.cacheDir, key[:2], key + ext)
+
+    def get(self, key, ext):
+        path = self.path(key, ext)
+        try:
+            # entries are evicted oldest modification time first
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, ext, sourcePath):
+        """
+        Move @sourcePath into the cache under @key and return its cached path.
+        """
+        path = self.path(key, ext)
+        dirName = os.path.dirname(path)
+        if not os.path.isdir(dirName):
+            try:
+                os.makedirs(dirName)
+            except OSError:
+                if not os.path.isdir(dirName):
+                    raise
+        fd, tmpPath = tempfile.mkstemp(dir=dirName, suffix='.part')
+        os.close(fd)
+        shutil.move(sourcePath, tmpPath)
+        os.rename(tmpPath, path)
+        if self.maxBytes:
+            self._grew(os.path.getsize(path))
+        return path
+
+    def _grew(self, size):
+        self._lock.acquire()
+        try:
+            self._added += size
+            if self._size is None or self._size + self._added > self.maxBytes or self._added > self.maxBytes / 10:
+                self._size = self._evict()
+                self._added = 0
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        # measure the cache and remove the least recently used entries until it is back under
+        # nine tenths of maxBytes, so the next eviction doesn't follow right away; returns the
+        # size it was left at
+        entries = []
+        for dirPath, dirNames, fileNames in os.walk(self.cacheDir):
+            for name in fileNames:
+                if name.endswith('.part'):
+                    continue
+                path = os.path.join(dirPath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # evicted by another worker meanwhile
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum([entry[1] for entry in entries])
+        if total > self.maxBytes:
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.maxBytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+        return total
+
+class Derivative:
+    """
+    An encoded derivative ready for upload.  Call release() once it has been uploaded, which
+    removes it unless it lives in the cache.
+    """
+    def __init__(self, path, workDir=None):
+        self.path = path
+        self.workDir = workDir
+
+    def release(self):
+        if self.workDir:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            shutil.rmtree(self.workDir, ignore_errors=True)
+            self.workDir = None
+
+def _encodeJp2(encoderName, tiffPath, workDir):
+    # runs in the engine's worker pool
+    return getEncoder(encoderName).encode(tiffPath, workDir)
+
+class DerivativeEngine:
+    def __init__(self, encoder='dlxs', workers=2, cacheDir=None, cacheMaxBytes=None):
+        """
+        @param encoder The name of a registered Jp2Encoder
+        @param workers How many encodes may run at the same time
+        @param cacheDir Where to cache derivatives, None to disable the cache
+        @param cacheMaxBytes About how large the cache may grow, None for no limit
+        """
+        getEncoder(encoder) # fail early on a bad name
+        self.encoder = encoder
+        self.workers = max(1, workers)
+        self.cache = cacheDir and DerivativeCache(cacheDir, cacheMaxBytes) or None
+        self._pool = None
+        self._poolPid = None
+        self._lock = threading.Lock()
+
+    def _getPool(self):
+        self._lock.acquire()
+        try:
+            if self._pool is None or self._poolPid != os.getpid():
+                if multiprocessing.current_process().daemon:
+                    # a worker of a process pool may not start processes of its own, encode from
+                    # threads instead - the encoders are external programs anyway
+                    self._pool = multiprocessing.dummy.Pool(self.workers)
+                else:
+                    self._pool = multiprocessing.Pool(self.workers)
+                self._poolPid = os.getpid()
+            return self._pool
+        finally:
+            self._lock.release()
+
+    def encodeJp2(self, tiffPath):
+        """
+        Return a Derivative holding the jp2 of @tiffPath, from the cache when it has already been
+        encoded.  Blocks until the encode is done; call it from several threads to keep all of
+        the workers busy.
+        """
+        key = None
+        if self.cache:
+            key = fileChecksum(tiffPath)
+            cached = self.cache.get(key, '.jp2')
+            if cached:
+                return Derivative(cached)
+        workDir = tempfile.mkdtemp(prefix='jp2-')
+        try:
+            jp2Path = self._getPool().apply(_encodeJp2, (self.encoder, tiffPath, workDir))
+            if key:
+                jp2Path = self.cache.put(key, '.jp2', jp2Path)
+                shutil.rmtree(workDir, ignore_errors=True)
+                return Derivative(jp2Path)
+        except:
+            shutil.rmtree(workDir, ignore_errors=True)
+            raise
+        return Derivative(jp2Path, workDir)
+
+    def close(self):
+        if self._pool is not None and self._poolPid == os.getpid():
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+
+JHOVE = '/opt/jhove/jhove'
+JHOVE2MIX_XSLT = 'data/jhove2mix.xslt'
+
+def _extractMix(tiffPath, jhove, xslt):
+    #cmd= jhove -h xml $INFILE | xsltproc jhove2mix.xslt - > `basename ${$INFILE%.*}.mix`
+    jhoveCmd1 = [jhove, "-h", "xml", tiffPath]
+    jhoveCmd2 = ["xsltproc", xslt, "-"] # complete cmd for xsltproc
+    #jhoveCmd2 = ["xalan", "-xsl", "data/jhove2mix.xslt"] # complete cmd for xalan
+    try:
+        p1 = subprocess.Popen(jhoveCmd1, stdout=subprocess.PIPE)
+    except OSError, ex:
+        raise RuntimeError("jhove conversion failed for %s: %s" % (tiffPath, ex))
+    try:
+        p2 = subprocess.Popen(jhoveCmd2, stdin=p1.stdout, stdout=subprocess.PIPE)
+    except OSError, ex:
+        p1.kill()
+        p1.wait()
+        raise RuntimeError("jhove conversion failed for %s: %s" % (tiffPath, ex))
+    p1.stdout.close() # so jhove sees a broken pipe if xsltproc dies
+    mix = p2.communicate()[0]
+    p1.wait()
+    if p1.returncode != 0 or p2.returncode != 0 or not mix.strip():
+        raise RuntimeError("jhove conversion failed for %s (jhove %s, xsltproc %s)" % (tiffPath, p1.returncode, p2.returncode))
+    return mix
+
+class _CachedResult:
+    # stands in for an AsyncResult when the answer is already known
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, timeout=None):
+        return self.value
+
+class _CachingResult:
+    # an AsyncResult that stores its value in the cache once it arrives
+    def __init__(self, result, cache, key):
+        self.result = result
+        self.cache = cache
+        self.key = key
+
+    def get(self, timeout=None):
+        mix = self.result.get(timeout)
+        if self.cache and self.key and not self.cache.get(self.key, '.mix.xml'):
+            fd, tmpPath = tempfile.mkstemp(suffix='.mix.xml')
+            os.write(fd, mix)
+            os.close(fd)
+            self.cache.put(self.key, '.mix.xml', tmpPath)
+        return mix
+
+class MixExtractor:
+    """
+    Extracts MIX metadata from TIFFs, running up to @workers jhove | xsltproc pipelines at once.
+    Each jhove run pays for a JVM start, so extraction is meant to be started early with submit()
+    and collected when the datastream is uploaded.  Results are cached by the TIFF's checksum.
+    """
+    def __init__(self, workers=2, cacheDir=None, jhove=JHOVE, xslt=JHOVE2MIX_XSLT, cacheMaxBytes=None):
+        self.workers = max(1, workers)
+        self.cache = cacheDir and DerivativeCache(cacheDir, cacheMaxBytes) or None
+        self.jhove = jhove
+        self.xslt = xslt
+        self._pool = None
+        self._poolPid = None
+        self._lock = threading.Lock()
+
+    def _getPool(self):
+        self._lock.acquire()
+        try:
+            if self._pool is None or self._poolPid != os.getpid():
+                # the work happens in jhove and xsltproc, threads only wait on them
+                self._pool = multiprocessing.dummy.Pool(self.workers)
+                self._poolPid = os.getpid()
+            return self._pool
+        finally:
+            self._lock.release()
+
+    def submit(self, tiffPath):
+        """
+        Start extracting the MIX of @tiffPath.  Returns an object whose get() waits for and
+        returns the MIX xml as a string, raising RuntimeError if jhove failed.
+        """
+        key = None
+        if self.cache:
+            key = fileChecksum(tiffPath)
+            cached = self.cache.get(key, '.mix.xml')
+            if cached:
+                f = open(cached, 'rb')
+                try:
+                    return _CachedResult(f.read())
+                finally:
+                    f.close()
+        result = self._getPool().apply_async(_extractMix, (tiffPath, self.jhove, self.xslt))
+        return _CachingResult(result, self.cache, key)
+
+    def extract(self, tiffPath):
+        return self.submit(tiffPath).get()
+
+    def close(self):
+        if self._pool is not None and self._poolPid == os.getpid():
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
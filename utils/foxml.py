@@ -0,0 +1,195 @@
+"""
+Build FOXML 1.1 documents, so an object can be created together with its RELS-EXT (and other
+datastreams) in a single ingest call instead of createObject followed by separate updates.
+"""
+
+import os
+import re
+import uuid
+import base64
+import hashlib
+from lxml import etree
+
+FOXML_NS = 'info:fedora/fedora-system:def/foxml#'
+RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+OAI_DC_NS = 'http://www.openarchives.org/OAI/2.0/oai_dc/'
+DC_NS = 'http://purl.org/dc/elements/1.1/'
+MODEL_NS = 'info:fedora/fedora-system:def/model#'
+RELS_EXT_NS = 'info:fedora/fedora-system:def/relations-external#'
+
+def _foxml(tag):
+    return '{%s}%s' % (FOXML_NS, tag)
+
+def _predicateName(predicate):
+    # extraRelationships keys are fedora_relationships.rels_predicate objects or (alias, name) tuples
+    if isinstance(predicate, tuple):
+        return predicate
+    return predicate.alias, predicate.predicate
+
+def buildRelsExt(pid, contentModel, parentPid, extraNamespaces={}, extraRelationships={}):
+    """
+    Return the RELS-EXT rdf:RDF element createRelsExt would write for the object: hasModel
+    @contentModel, isMemberOfCollection @parentPid, plus @extraRelationships (predicate -> pid)
+    whose prefixes are declared in @extraNamespaces (alias -> uri).
+    """
+    nsmap = {'rdf': RDF_NS, 'fedora': RELS_EXT_NS, 'fedora-model': MODEL_NS}
+    nsmap.update(extraNamespaces or {})
+    rdf = etree.Element('{%s}RDF' % RDF_NS, nsmap=nsmap)
+    description = etree.SubElement(rdf, '{%s}Description' % RDF_NS)
+    description.set('{%s}about' % RDF_NS, 'info:fedora/%s' % pid)
+    relationships = [(('fedora-model', 'hasModel'), contentModel), (('fedora', 'isMemberOfCollection'), parentPid)]
+    relationships.extend([(_predicateName(k), v) for k, v in (extraRelationships or {}).iteritems()])
+    for (alias, name), value in relationships:
+        rel = etree.SubElement(description, '{%s}%s' % (nsmap[alias], name))
+        # stored as rdf:resource, like the "pid" relationships createRelsExt adds
+        rel.set('{%s}resource' % RDF_NS, 'info:fedora/%s' % value)
+    return rdf
+
+def buildDc(pid, title, isPartOf=None):
+    """
+    Return an oai_dc document (a utf-8 string) with @title and @pid as identifier, and, if
+    given, the pid @isPartOf as relation - the DC of an object that has no DC file of its own,
+    such as a manuscript page.
+    """
+    dc = etree.Element('{%s}dc' % OAI_DC_NS, nsmap={'oai_dc': OAI_DC_NS, 'dc': DC_NS})
+    etree.SubElement(dc, '{%s}title' % DC_NS).text = title
+    etree.SubElement(dc, '{%s}identifier' % DC_NS).text = pid
+    if isPartOf:
+        etree.SubElement(dc, '{%s}relation' % DC_NS).text = 'info:fedora/%s' % (isPartOf,)
+    return etree.tostring(dc, encoding='UTF-8', xml_declaration=True)
+
+# bytes of source content base64 encoded at a time; a multiple of 3, so the encoded blocks
+# simply concatenate
+_BASE64_BLOCK = 3 * 256 * 1024
+
+class FoxmlDatastream:
+    """
+    A managed datastream to embed in a FOXML document, with its content either inline (sent
+    base64 encoded inside the document) or referenced by a URL fedora fetches itself.  Use the
+    from* constructors.
+    """
+    def __init__(self, dsid, label, mimeType, opener=None, size=None, url=None):
+        self.dsid = dsid
+        self.label = label
+        self.mimeType = mimeType
+        self.opener = opener
+        self.size = size
+        self.url = url
+        # MD5 (hex) of inline content, known once iterEncoded has read all of it
+        self.checksum = None
+
+    @classmethod
+    def fromString(cls, dsid, label, mimeType, data):
+        from StringIO import StringIO
+        return cls(dsid, label, mimeType, lambda: StringIO(data), len(data))
+
+    @classmethod
+    def fromFile(cls, dsid, label, mimeType, path):
+        return cls(dsid, label, mimeType, lambda: open(path, 'rb'), os.path.getsize(path))
+
+    @classmethod
+    def fromStream(cls, dsid, label, mimeType, opener, size):
+        """
+        @opener is called once, when the content is sent, and must return a file-like object
+        holding exactly @size bytes (e.g. lambda: zipFile.open(info), info.file_size).
+        """
+        return cls(dsid, label, mimeType, opener, size)
+
+    @classmethod
+    def fromUrl(cls, dsid, label, mimeType, url):
+        return cls(dsid, label, mimeType, url=url)
+
+    def encodedSize(self):
+        return 4 * ((self.size + 2) // 3)
+
+    def iterEncoded(self):
+        f = self.opener()
+        md5 = hashlib.md5()
+        try:
+            sent = 0
+            carry = ''
+            while True:
+                block = f.read(_BASE64_BLOCK)
+                if not block:
+                    break
+                sent += len(block)
+                md5.update(block)
+                block = carry + block
+                cut = len(block) - len(block) % 3
+                carry = block[cut:]
+                if cut:
+                    yield base64.b64encode(block[:cut])
+            if carry:
+                yield base64.b64encode(carry)
+        finally:
+            f.close()
+        if sent != self.size:
+            # the request was sent with a content length computed from self.size
+            raise IOError("datastream %s: expected %d bytes, read %d" % (self.dsid, self.size, sent))
+        self.checksum = md5.hexdigest()
+
+def _buildObject(pid, label, relsExt, state):
+    obj = etree.Element(_foxml('digitalObject'), nsmap={'foxml': FOXML_NS})
+    obj.set('VERSION', '1.1')
+    obj.set('PID', pid)
+    properties = etree.SubElement(obj, _foxml('objectProperties'))
+    for name, value in ((MODEL_NS + 'state', state), (MODEL_NS + 'label', label)):
+        prop = etree.SubElement(properties, _foxml('property'))
+        prop.set('NAME', name)
+        prop.set('VALUE', value)
+    if relsExt is not None:
+        ds = etree.SubElement(obj, _foxml('datastream'), ID='RELS-EXT', CONTROL_GROUP='X', STATE='A', VERSIONABLE='true')
+        version = etree.SubElement(ds, _foxml('datastreamVersion'), ID='RELS-EXT.0', MIMETYPE='application/rdf+xml',
+                                   LABEL='Fedora Object-to-Object Relationship Metadata')
+        content = etree.SubElement(version, _foxml('xmlContent'))
+        content.append(relsExt)
+    return obj
+
+def buildFoxml(pid, label, relsExt=None, state=u'A'):
+    """
+    Return a FOXML 1.1 document (a utf-8 string) for a new object with the given @label and,
+    if given, @relsExt (an element from buildRelsExt) as its inline RELS-EXT datastream.
+    """
+    return etree.tostring(_buildObject(pid, label, relsExt, state), encoding='UTF-8', xml_declaration=True)
+
+def streamFoxml(pid, label, relsExt=None, datastreams=[], state=u'A'):
+    """
+    Like buildFoxml, but with managed @datastreams (FoxmlDatastream objects) as well.  Returns
+    (body, length): an iterator over the document's pieces and its exact size in bytes.  Inline
+    content is only read, and base64 encoded block by block, while @body is consumed, so a
+    document carrying multi-GB masters never needs to be held in memory.  Once @body has been
+    consumed, each inline datastream's checksum holds the MD5 of its content.
+    """
+    obj = _buildObject(pid, label, relsExt, state)
+    # marks where inline content goes once the document is serialized
+    marker = 'foxml-content-%s-' % uuid.uuid4().hex
+    for n, ds in enumerate(datastreams):
+        dsElement = etree.SubElement(obj, _foxml('datastream'), ID=ds.dsid, CONTROL_GROUP='M', STATE='A', VERSIONABLE='true')
+        version = etree.SubElement(dsElement, _foxml('datastreamVersion'), ID='%s.0' % ds.dsid, MIMETYPE=ds.mimeType, LABEL=ds.label)
+        if ds.url:
+            etree.SubElement(version, _foxml('contentLocation'), TYPE='URL', REF=ds.url)
+        else:
+            # no DIGEST: fedora computes the checksum itself, checked later against ds.checksum
+            etree.SubElement(version, _foxml('contentDigest'), TYPE='MD5')
+            etree.SubElement(version, _foxml('binaryContent')).text = '%s%d.' % (marker, n)
+    document = etree.tostring(obj, encoding='UTF-8', xml_declaration=True)
+    pieces = re.split('(%s\\d+\\.)' % re.escape(marker), document)
+
+    inline = {}
+    length = 0
+    for piece in pieces:
+        if piece.startswith(marker):
+            ds = datastreams[int(piece[len(marker):-1])]
+            inline[piece] = ds
+            length += ds.encodedSize()
+        else:
+            length += len(piece)
+
+    def body():
+        for piece in pieces:
+            if piece in inline:
+                for block in inline[piece].iterEncoded():
+                    yield block
+            else:
+                yield piece
+    return body(), length
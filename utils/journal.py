@@ -0,0 +1,211 @@
+"""
+Durable record of finished migration steps, so an interrupted run can pick up where it stopped.
+
+Steps are recorded per object (keyed by pid) in a local SQLite database, e.g. 'object' once the
+fedora object exists, one step per datastream, and 'complete' when nothing is left to do.  The
+journal can be shared by several worker processes and threads: every thread of every process
+gets its own SQLite connection, and writers wait on each other through SQLite's own locking.
+
+The journal also keeps the checksum of every datastream as it was sent, for verifying later
+that fedora holds the same content, and the size and modification time of the source files of
+migrated objects, so a later sync run can tell which of them changed.
+"""
+
+import os
+import re
+import time
+import threading
+import sqlite3
+
+# step recorded once everything for an object has been done
+COMPLETE = 'complete'
+# times creating the schema is tried when another connection changes it at the same moment
+SCHEMA_ATTEMPTS = 10
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS steps (
+    pid TEXT NOT NULL,
+    step TEXT NOT NULL,
+    collection TEXT,
+    finished REAL NOT NULL,
+    info TEXT,
+    PRIMARY KEY (pid, step)
+);
+CREATE TABLE IF NOT EXISTS checksums (
+    pid TEXT NOT NULL,
+    dsid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    checksum TEXT NOT NULL,
+    size INTEGER,
+    recorded REAL NOT NULL,
+    PRIMARY KEY (pid, dsid)
+);
+CREATE TABLE IF NOT EXISTS sources (
+    pid TEXT NOT NULL,
+    step TEXT NOT NULL,
+    path TEXT NOT NULL,
+    member TEXT,
+    size INTEGER,
+    mtime REAL,
+    crc INTEGER,
+    recorded REAL NOT NULL,
+    PRIMARY KEY (pid, step)
+)
+"""
+
+# matches the pids of the pages of the book given as the two GLOB patterns of _childPatterns
+_CHILDREN = "(pid GLOB ? AND pid NOT GLOB ?)"
+
+def _childPatterns(pid):
+    # a page's pid is '<pid>-' and the page number, nothing but digits; GLOB has no escape
+    # character, its special characters in @pid are matched by sets holding only them
+    prefix = re.sub(r'([*?[])', r'[\1]', pid) + '-'
+    return (prefix + '[0-9]*', prefix + '*[^0-9]*')
+
+class MigrationJournal:
+    def __init__(self, path, timeout=60.0):
+        """
+        @param path The SQLite file to keep the journal in, created if missing
+        @param timeout Seconds to wait for another writer before giving up
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._createSchema()
+
+    def _createSchema(self):
+        # every worker opening a new journal creates the schema at once.  The tables are created
+        # in one write transaction (on a connection of its own, as the sqlite3 module would
+        # commit before every CREATE), and an attempt that trips over the schema another worker
+        # has just changed is simply made again
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        try:
+            for attempt in range(1, SCHEMA_ATTEMPTS + 1):
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    for statement in _SCHEMA.split(';'):
+                        conn.execute(statement)
+                    conn.execute("COMMIT")
+                    return
+                except sqlite3.OperationalError, ex:
+                    if 'schema has changed' not in str(ex) or attempt == SCHEMA_ATTEMPTS:
+                        raise
+                    try:
+                        conn.execute("ROLLBACK")
+                    except sqlite3.OperationalError:
+                        pass
+        finally:
+            conn.close()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            try:
+                # lets readers carry on while another worker is writing
+                conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.DatabaseError:
+                pass
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def doneSteps(self, pid):
+        """
+        Return the set of steps already finished for @pid.
+        """
+        cursor = self._connection().execute("SELECT step FROM steps WHERE pid = ?", (pid,))
+        return set(row[0] for row in cursor)
+
+    def isDone(self, pid, step):
+        cursor = self._connection().execute("SELECT 1 FROM steps WHERE pid = ? AND step = ?", (pid, step))
+        return cursor.fetchone() is not None
+
+    def markDone(self, pid, step, collection=None, info=None):
+        """
+        Record that @step has finished for @pid.  The record is committed before returning.
+        """
+        conn = self._connection()
+        conn.execute("INSERT OR REPLACE INTO steps (pid, step, collection, finished, info) VALUES (?, ?, ?, ?, ?)",
+                     (pid, step, collection, time.time(), info))
+        conn.commit()
+
+    def markDoneMany(self, steps, collection=None):
+        """
+        Record a list of (pid, step) pairs in a single transaction.
+        """
+        now = time.time()
+        conn = self._connection()
+        conn.executemany("INSERT OR REPLACE INTO steps (pid, step, collection, finished, info) VALUES (?, ?, ?, ?, NULL)",
+                         [(pid, step, collection, now) for pid, step in steps])
+        conn.commit()
+
+    def forgetSteps(self, pid, steps):
+        """
+        Drop the given @steps of @pid, so the next run does them again.
+        """
+        conn = self._connection()
+        conn.executemany("DELETE FROM steps WHERE pid = ? AND step = ?", [(pid, step) for step in steps])
+        conn.commit()
+
+    def recordChecksums(self, checksums, type='MD5'):
+        """
+        Record the checksums of datastreams as they were sent, a list of (pid, dsid, checksum, size).
+        """
+        now = time.time()
+        conn = self._connection()
+        conn.executemany("INSERT OR REPLACE INTO checksums (pid, dsid, type, checksum, size, recorded) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(pid, dsid, type, checksum, size, now) for pid, dsid, checksum, size in checksums])
+        conn.commit()
+
+    def recordChecksum(self, pid, dsid, checksum, size=None, type='MD5'):
+        self.recordChecksums([(pid, dsid, checksum, size)], type)
+
+    def sentChecksum(self, pid, dsid):
+        """
+        Return (type, checksum) recorded for datastream @dsid of @pid, or None.
+        """
+        cursor = self._connection().execute("SELECT type, checksum FROM checksums WHERE pid = ? AND dsid = ?", (pid, dsid))
+        return cursor.fetchone()
+
+    def checksums(self, pid, children=False):
+        """
+        Return (pid, dsid, type, checksum, size) for every datastream of @pid with a recorded
+        checksum, and if @children for those of the objects whose pid is @pid followed by '-' and
+        a page number (the pages of a book).
+        """
+        if children:
+            cursor = self._connection().execute("SELECT pid, dsid, type, checksum, size FROM checksums WHERE pid = ? OR %s ORDER BY pid, dsid" % (_CHILDREN,), (pid,) + _childPatterns(pid))
+        else:
+            cursor = self._connection().execute("SELECT pid, dsid, type, checksum, size FROM checksums WHERE pid = ? ORDER BY dsid", (pid,))
+        return cursor.fetchall()
+
+    def recordSources(self, sources):
+        """
+        Record the source files journal steps were made from, a dict of (pid, step) to
+        (path, member, size, mtime, crc): @member names the zip member the content came from (with
+        @crc its CRC-32), None for plain files.
+        """
+        now = time.time()
+        conn = self._connection()
+        conn.executemany("INSERT OR REPLACE INTO sources (pid, step, path, member, size, mtime, crc, recorded) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         [key + source + (now,) for key, source in sources.iteritems()])
+        conn.commit()
+
+    def sources(self, pid, children=False):
+        """
+        Return the sources recorded for @pid (and, if @children, its pages as for checksums()) in
+        the form recordSources takes them.
+        """
+        query = "SELECT pid, step, path, member, size, mtime, crc FROM sources WHERE pid = ?"
+        args = (pid,)
+        if children:
+            query += " OR " + _CHILDREN
+            args = (pid,) + _childPatterns(pid)
+        return dict((tuple(row[:2]), tuple(row[2:])) for row in self._connection().execute(query, args))
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
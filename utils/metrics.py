@@ -0,0 +1,215 @@
+"""
+Timing and throughput records for the migration.
+
+Every timed stage (a database query, a jp2 encode, a datastream upload, ...) is written as one
+JSON line to the metrics file, with how long it took and how many bytes it moved, so a slow run
+can be picked apart afterwards with any JSON tool.  A rolling summary of items per hour and MB/s
+over the last few minutes is printed, and recorded, at regular intervals.
+
+Each process keeps its own counters; every record carries the process id, so the workers of a
+parallel run can share one file.
+"""
+
+import os
+import sys
+import time
+import json
+import threading
+import collections
+import cProfile
+from contextlib import contextmanager
+
+class Metrics:
+    def __init__(self, path=None, summaryInterval=None, window=600.0):
+        """
+        @param path The JSON lines file records are appended to, None to only keep the totals
+        @param summaryInterval Seconds between rolling summaries, None for no summaries
+        @param window Seconds of history the rolling rates are computed over
+        """
+        self.path = path
+        self.summaryInterval = summaryInterval
+        self.window = window
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._file = None
+        self._started = time.time()
+        self._lastSummary = self._started
+        # (time, items, bytes) of everything finished within the window
+        self._events = collections.deque()
+        # stage -> [count, seconds, bytes] since the start
+        self._totals = {}
+        self._items = 0
+
+    def _checkFork(self):
+        # a forked worker starts its own counters and its own handle on the file
+        if self._pid != os.getpid():
+            self._reset()
+
+    def addCounters(self, name, func):
+        """
+        Include the dict returned by @func() under @name in every summary, e.g. the RELS-EXT
+        retry counters of utils.commonFedora.
+        """
+        self._counters[name] = func
+
+    def record(self, stage, elapsed, bytes=0, **fields):
+        """
+        Record that @stage took @elapsed seconds and moved @bytes bytes to or from fedora.  Any
+        other @fields (a pid, a dsid, ...) are written along with the record.
+        """
+        now = time.time()
+        entry = {'type': 'stage', 'stage': stage, 'time': round(now, 3), 'elapsed': round(elapsed, 6),
+                 'bytes': bytes, 'process': os.getpid(), 'thread': threading.currentThread().getName()}
+        entry.update(fields)
+        self._lock.acquire()
+        try:
+            self._checkFork()
+            totals = self._totals.setdefault(stage, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += elapsed
+            totals[2] += bytes
+            if bytes:
+                self._events.append((now, 0, bytes))
+            self._write(entry)
+            self._summarizeIfDue(now)
+        finally:
+            self._lock.release()
+
+    def itemDone(self):
+        """
+        Count one more migrated item towards the items per hour rate.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._checkFork()
+            self._items += 1
+            self._events.append((now, 1, 0))
+            self._summarizeIfDue(now)
+        finally:
+            self._lock.release()
+
+    @contextmanager
+    def timed(self, stage, bytes=0, **fields):
+        """
+        with metrics.timed('encode.jp2', pid=pid) as info: ... - record how long the block took.
+        The block may add fields to, or set 'bytes' in, the @info dict it is given.  A block that
+        raises is recorded with the exception's class as 'error'.
+        """
+        info = dict(fields)
+        info['bytes'] = bytes
+        start = time.time()
+        ok = False
+        try:
+            yield info
+            ok = True
+        finally:
+            if not ok:
+                info['error'] = sys.exc_info()[0].__name__
+            self.record(stage, time.time() - start, **info)
+
+    def summary(self):
+        """
+        Return the current summary: totals per stage since the start plus the item and byte rates
+        over the last @window seconds.
+        """
+        self._lock.acquire()
+        try:
+            self._checkFork()
+            return self._summary(time.time())
+        finally:
+            self._lock.release()
+
+    def totalBytes(self):
+        """
+        Return the bytes this process has recorded since the start, over all stages.
+        """
+        self._lock.acquire()
+        try:
+            self._checkFork()
+            return sum([t[2] for t in self._totals.itervalues()])
+        finally:
+            self._lock.release()
+
+    def _summary(self, now):
+        while self._events and self._events[0][0] < now - self.window:
+            self._events.popleft()
+        span = max(min(self.window, now - self._started), 1e-6)
+        items = sum([e[1] for e in self._events])
+        bytes = sum([e[2] for e in self._events])
+        summary = {'type': 'summary', 'time': round(now, 3), 'process': os.getpid(), 'items': self._items,
+                   'items_per_hour': round(items * 3600.0 / span, 2), 'mb_per_s': round(bytes / span / (1024 * 1024), 3),
+                   'stages': dict((stage, {'count': t[0], 'seconds': round(t[1], 3), 'bytes': t[2]}) for stage, t in self._totals.iteritems())}
+        for name, func in self._counters.iteritems():
+            summary[name] = func()
+        return summary
+
+    def _summarizeIfDue(self, now):
+        if self.summaryInterval is None or now - self._lastSummary < self.summaryInterval:
+            return
+        self._lastSummary = now
+        summary = self._summary(now)
+        self._write(summary)
+        print 'metrics - %d items, %.1f items/hour, %.2f MB/s over the last %ds' % (summary['items'], summary['items_per_hour'], summary['mb_per_s'], self.window)
+
+    def _write(self, entry):
+        if not self.path:
+            return
+        if self._file is None:
+            # line buffered, so a forked worker never inherits half a line
+            self._file = open(self.path, 'a', 1)
+        self._file.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        """
+        Write a final summary and close the file.
+        """
+        self._lock.acquire()
+        try:
+            self._checkFork()
+            if self.summaryInterval is not None or self._totals:
+                self._write(self._summary(time.time()))
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        finally:
+            self._lock.release()
+
+_metrics = Metrics()
+
+def configure(path=None, summaryInterval=None, window=600.0):
+    """
+    Set where the process-wide metrics go, see Metrics.
+    """
+    _metrics.close()
+    _metrics.path = path
+    _metrics.summaryInterval = summaryInterval
+    _metrics.window = window
+
+def getMetrics():
+    return _metrics
+
+def timed(stage, bytes=0, **fields):
+    """
+    Metrics.timed on the process-wide metrics.
+    """
+    return _metrics.timed(stage, bytes, **fields)
+
+@contextmanager
+def profiled(path):
+    """
+    with profiled('item.prof'): ... - run the block under cProfile and dump the stats to @path
+    (read them with pstats).  Only the calling thread is profiled; work the block hands to
+    pipeline threads or worker pools shows up as time spent waiting on them.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,62 @@
+"""
+Helpers for reading the legacy DRL METS files.
+"""
+
+from lxml import etree
+
+METS_NS = 'http://www.loc.gov/METS/'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
+_FILE = '{%s}file' % METS_NS
+_DIV = '{%s}div' % METS_NS
+_FPTR = '{%s}fptr' % METS_NS
+_HREF = '{%s}href' % XLINK_NS
+
+def _discard(elem):
+    # free a finished element and the siblings before it, the parse tree never grows past the
+    # elements still open
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+def getPageLabels(mets):
+    """
+    Map the file name (xlink:href) of every mets:file to the LABEL of the page div
+    (mets:div[@TYPE="page"]) whose mets:fptr points at it.  Files that no page points at are
+    left out.
+
+    The document is read once, as a stream, so the work grows linearly with the number of pages
+    and memory stays flat however large the METS is.
+    @param mets The path of the METS file or an open file object
+    """
+    fileNames = {} # mets:file ID -> href
+    fileLabels = {} # FILEID -> LABEL of the first page div pointing at it
+    # (isPage, label) of every mets:div currently open, innermost last
+    divs = []
+    for event, elem in etree.iterparse(mets, events=('start', 'end')):
+        if elem.tag not in (_FILE, _DIV, _FPTR):
+            continue
+        if event == 'start':
+            if elem.tag == _DIV:
+                divs.append((elem.get('TYPE') == 'page', elem.get('LABEL')))
+            continue
+        if elem.tag == _FILE:
+            if len(elem):
+                fileNames[elem.get('ID')] = elem[0].get(_HREF)
+            _discard(elem)
+        elif elem.tag == _FPTR:
+            fileId = elem.get('FILEID')
+            if divs and divs[-1][0] and fileId not in fileLabels:
+                fileLabels[fileId] = divs[-1][1]
+            _discard(elem)
+        else:
+            divs.pop()
+            _discard(elem)
+
+    labels = {}
+    for fileId, fileName in fileNames.iteritems():
+        if fileId in fileLabels:
+            labels[fileName] = fileLabels[fileId]
+    return labels
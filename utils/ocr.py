@@ -0,0 +1,49 @@
+"""
+Reading the per-page OCR of a book out of its OCR zip.
+"""
+
+import os
+import zipfile
+
+# bytes of a page's text read from the zip at a time while it is streamed
+OCR_BLOCK_SIZE = 64 * 1024
+
+class OcrZip:
+    """
+    A book's OCR zip, one <page>.txt member per page image <page>.tif.  The members are indexed
+    by name once when the zip is opened, so finding a page's text is a dict lookup rather than a
+    scan of namelist().  Members are opened by file name, so several threads may read pages at
+    the same time.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path, 'r')
+        self.members = dict((info.filename, info) for info in self.zip.infolist())
+
+    def pageInfo(self, pageName):
+        """
+        Return the ZipInfo of the OCR of page image @pageName, or None if the page has none.
+        """
+        return self.members.get('%s.txt' % (os.path.splitext(pageName)[0],))
+
+    def open(self, info):
+        return self.zip.open(info)
+
+    def iterText(self, infos, blockSize=OCR_BLOCK_SIZE):
+        """
+        Yield the text of each member of @infos in turn, @blockSize bytes at a time, so only one
+        block is held in memory however long the book is.
+        """
+        for info in infos:
+            f = self.zip.open(info)
+            try:
+                while True:
+                    block = f.read(blockSize)
+                    if not block:
+                        break
+                    yield block
+            finally:
+                f.close()
+
+    def close(self):
+        self.zip.close()
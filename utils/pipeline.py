@@ -0,0 +1,143 @@
+"""
+Small staged pipeline built on threads and bounded queues.
+
+Each stage has its own pool of worker threads and hands its jobs to the next stage through a
+bounded queue, so a slow stage applies backpressure instead of letting work pile up in memory.
+Stages are expected to spend their time in subprocesses or network I/O, which release the GIL.
+"""
+
+import sys
+import threading
+import Queue
+
+# marks the end of the job stream on a stage's input queue
+_STOP = object()
+
+class PipelineError(Exception):
+    """
+    Raised by Pipeline.run when one or more jobs failed.  @errors is a list of
+    (index, stageName, exc_info) tuples in job order.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        index, stageName, exc_info = errors[0]
+        Exception.__init__(self, "%d job(s) failed, first: job %d in stage '%s': %s" % (len(errors), index, stageName, exc_info[1]))
+
+class _Stage:
+    def __init__(self, name, func, workers, batchSize=None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.batchSize = batchSize
+
+class Pipeline:
+    def __init__(self, queueSize=4):
+        """
+        @param queueSize The maximum number of jobs waiting in front of each stage
+        """
+        self.queueSize = queueSize
+        self.stages = []
+
+    def addStage(self, name, func, workers=1):
+        """
+        Append a stage.  @func is called with the job returned by the previous stage (or the
+        original job for the first stage) and returns the job to hand to the next stage.
+        @workers is the number of threads running this stage at the same time.
+        """
+        self.stages.append(_Stage(name, func, workers))
+        return self
+
+    def addBatchStage(self, name, func, batchSize, workers=1):
+        """
+        Append a stage that handles jobs @batchSize at a time: @func is called with a list of up to
+        @batchSize jobs and returns the list of jobs for the next stage, in the same order.  If
+        @func raises, every job of the batch counts as failed.
+        """
+        self.stages.append(_Stage(name, func, workers, max(1, batchSize)))
+        return self
+
+    def run(self, jobs):
+        """
+        Push every job in @jobs through all stages and return the final results in the order the
+        jobs were given, whatever order the stages finished them in.  A job that raises is dropped
+        from the remaining stages; once everything has drained a PipelineError is raised listing
+        the failures.
+        """
+        if not self.stages:
+            return list(jobs)
+        queues = [Queue.Queue(self.queueSize) for stage in self.stages]
+        results = {}
+        errors = []
+        lock = threading.Lock()
+        threads = []
+        for i, stage in enumerate(self.stages):
+            if i + 1 < len(self.stages):
+                outQueue, nextWorkers = queues[i + 1], self.stages[i + 1].workers
+            else:
+                outQueue, nextWorkers = None, 0
+            remaining = [stage.workers]
+            for n in range(stage.workers):
+                t = threading.Thread(target=self._work, name="%s-%d" % (stage.name, n),
+                                     args=(stage, queues[i], outQueue, nextWorkers, remaining, results, errors, lock))
+                t.setDaemon(True)
+                t.start()
+                threads.append(t)
+
+        count = 0
+        try:
+            for job in jobs:
+                queues[0].put((count, job))
+                count += 1
+        finally:
+            for n in range(self.stages[0].workers):
+                queues[0].put(_STOP)
+            for t in threads:
+                t.join()
+
+        if errors:
+            errors.sort()
+            raise PipelineError(errors)
+        return [results[i] for i in range(count)]
+
+    def _work(self, stage, inQueue, outQueue, nextWorkers, remaining, results, errors, lock):
+        batch = []
+        while True:
+            entry = inQueue.get()
+            if entry is _STOP:
+                break
+            batch.append(entry)
+            if len(batch) >= (stage.batchSize or 1):
+                self._process(stage, batch, outQueue, results, errors, lock)
+                batch = []
+        if batch:
+            self._process(stage, batch, outQueue, results, errors, lock)
+        # the last worker of a stage to finish tells every worker of the next stage to stop
+        lock.acquire()
+        remaining[0] -= 1
+        last = remaining[0] == 0
+        lock.release()
+        if last and outQueue is not None:
+            for n in range(nextWorkers):
+                outQueue.put(_STOP)
+
+    def _process(self, stage, entries, outQueue, results, errors, lock):
+        indexes = [index for index, job in entries]
+        jobs = [job for index, job in entries]
+        try:
+            if stage.batchSize:
+                jobs = stage.func(jobs)
+            else:
+                jobs = [stage.func(jobs[0])]
+        except Exception:
+            exc_info = sys.exc_info()
+            lock.acquire()
+            errors.extend([(index, stage.name, exc_info) for index in indexes])
+            lock.release()
+            return
+        for index, job in zip(indexes, jobs):
+            if outQueue is None:
+                lock.acquire()
+                results[index] = job
+                lock.release()
+            else:
+                outQueue.put((index, job))
@@ -0,0 +1,115 @@
+"""
+Run reports mailed while a migration runs.
+
+A RunReport is told about every finished item by the process collecting the results.  At
+regular intervals it mails a summary of the interval (items per hour, failures, MB sent), and
+when the run ends a digest of the whole run with every failure.  The mail is sent by a
+utils.Mailer.AsyncSender, so neither the ingest workers nor the collecting loop ever wait on
+it.
+"""
+
+import time
+import threading
+from utils.Mailer import EmailMessage, AsyncSender
+
+class RunReport:
+    def __init__(self, title, addrs, transport=None, interval=3600, maxFailures=200):
+        """
+        @param title Names the run in the subject of every report
+        @param addrs The addresses reports go to, a list or a space separated string
+        @param transport The utils.Mailer transport to send through, None for the default (mailx)
+        @param interval Seconds between summaries, None for the end of run digest only
+        @param maxFailures How many failures a report lists one by one; the rest are only counted
+        """
+        self.title = title
+        self.addrs = addrs
+        self.interval = interval
+        self.maxFailures = maxFailures
+        self.sender = AsyncSender(transport)
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._items = 0
+        self._failures = []
+        # process id -> bytes that process had sent by its latest result
+        self._sent = {}
+        # the same counts as of the last summary
+        self._last = (self._started, 0, 0, 0)
+
+    def itemDone(self, doId, ok, message='', process=None, bytesSent=None):
+        """
+        Count one finished item.  @bytesSent is the total the worker @process had sent to fedora
+        when it finished the item (utils.metrics Metrics.totalBytes), so results may arrive from
+        any number of worker processes or threads and in any order.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._items += 1
+            if not ok:
+                self._failures.append((doId, message))
+            if bytesSent is not None:
+                self._sent[process] = max(bytesSent, self._sent.get(process, 0))
+            if self.interval is None or now - self._last[0] < self.interval:
+                return
+            summary = self._summary(now)
+            self._last = (now, self._items, len(self._failures), self._bytes())
+        finally:
+            self._lock.release()
+        self._submit('summary', summary)
+
+    def _bytes(self):
+        return sum(self._sent.values())
+
+    def _rate(self, count, seconds):
+        return count * 3600.0 / max(seconds, 1e-6)
+
+    def _failureLines(self, failures):
+        lines = ['  %s: %s' % failure for failure in failures[:self.maxFailures]]
+        if len(failures) > self.maxFailures:
+            lines.append('  ... and %d more' % (len(failures) - self.maxFailures,))
+        return lines
+
+    def _summary(self, now):
+        since, items, failures, sent = self._last
+        span = now - since
+        newFailures = self._failures[failures:]
+        lines = ['Last %d minutes:' % round(span / 60.0),
+                 '  %d items (%.1f per hour), %d failed' % (self._items - items, self._rate(self._items - items, span), len(newFailures)),
+                 '  %.1f MB sent (%.2f MB/s)' % ((self._bytes() - sent) / 1048576.0, (self._bytes() - sent) / 1048576.0 / max(span, 1e-6)),
+                 '',
+                 'Since the start (%s):' % time.strftime('%Y-%m-%d %H:%M', time.localtime(self._started)),
+                 '  %d items (%.1f per hour), %d failed, %.1f MB sent' % (self._items, self._rate(self._items, now - self._started), len(self._failures), self._bytes() / 1048576.0)]
+        if newFailures:
+            lines.extend(['', 'Failed since the last report:'] + self._failureLines(newFailures))
+        return lines
+
+    def _submit(self, kind, lines):
+        message = EmailMessage('%s - %s' % (self.title, kind), self.addrs)
+        message.addString('\n'.join(lines) + '\n')
+        self.sender.submit(message)
+
+    def digest(self):
+        """
+        Return the lines of the end of run digest.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            elapsed = now - self._started
+            lines = ['Started %s, finished %s (%.1f hours)' % (time.strftime('%Y-%m-%d %H:%M', time.localtime(self._started)),
+                                                             time.strftime('%Y-%m-%d %H:%M', time.localtime(now)), elapsed / 3600.0),
+                     '%d items (%.1f per hour), %d ok, %d failed' % (self._items, self._rate(self._items, elapsed), self._items - len(self._failures), len(self._failures)),
+                     '%.1f MB sent (%.2f MB/s)' % (self._bytes() / 1048576.0, self._bytes() / 1048576.0 / max(elapsed, 1e-6))]
+            if self._failures:
+                lines.extend(['', 'Failed items:'] + self._failureLines(self._failures))
+            return lines
+        finally:
+            self._lock.release()
+
+    def finish(self, timeout=300):
+        """
+        Send the end of run digest and wait up to @timeout seconds for the reports still queued
+        to go out.
+        """
+        self._submit(self._failures and 'finished with failures' or 'finished', self.digest())
+        self.sender.close(timeout)